@@ -0,0 +1,183 @@
+"""
+Отправка оплаченных заказов курьерам пачками.
+
+Заказы каждой пиццерии копятся BATCH_WINDOW секунд. Затем заказы,
+адреса которых ближе CLUSTER_RADIUS_KM друг к другу, объединяются
+в один маршрут. Курьер получает маршрут одним сообщением, а точки
+доставки приходят в порядке объезда: каждый раз к ближайшей
+из оставшихся, начиная от пиццерии.
+
+Пачки хранятся в Redis: список заказов на каждую пиццерию и время
+отправки пачки в хэше BATCHES_KEY, поэтому перезапуск бота не теряет
+оплаченные заказы. Пачки, время которых подошло, отправляет
+``flush_orders`` — его раз в несколько секунд вызывает job_queue.
+Заказ, который не удалось отправить курьеру, повторяется через
+RETRY_INTERVAL секунд, а после MAX_SEND_ATTEMPTS попыток переносится
+в список FAILED_ORDERS_KEY и пишется в лог.
+"""
+import json
+import logging
+import time
+
+from geocoder import get_distance
+
+BATCH_WINDOW = 60
+CLUSTER_RADIUS_KM = 1.5
+BATCHES_KEY = "courier_batches"
+FAILED_ORDERS_KEY = "courier_orders_failed"
+MAX_SEND_ATTEMPTS = 5
+RETRY_INTERVAL = 60
+
+logger = logging.getLogger(__name__)
+
+
+def get_orders_key(pizzeria_id):
+    return f"courier_orders:{pizzeria_id}"
+
+
+def add_order(bot, db, pizzeria, order):
+    """
+    pizzeria: {"id", "courier_id", "latitude", "longitude"}
+    order: {"text", "latitude", "longitude"}
+    """
+    if not BATCH_WINDOW:
+        retry_orders(db, pizzeria, send_routes(bot, pizzeria, [order]))
+        return
+    queue_order(db, pizzeria, order, BATCH_WINDOW)
+
+
+def queue_order(db, pizzeria, order, delay):
+    pipeline = db.pipeline()
+    pipeline.rpush(
+        get_orders_key(pizzeria["id"]),
+        json.dumps({"pizzeria": pizzeria, "order": order}, ensure_ascii=False),
+    )
+    pipeline.hsetnx(BATCHES_KEY, pizzeria["id"], time.time() + delay)
+    pipeline.execute()
+
+
+def retry_orders(db, pizzeria, orders):
+    """Ставит неотправленные заказы в очередь снова, пока есть попытки"""
+    for order in orders:
+        order["attempts"] = order.get("attempts", 0) + 1
+        if order["attempts"] < MAX_SEND_ATTEMPTS:
+            queue_order(db, pizzeria, order, RETRY_INTERVAL)
+            continue
+        logger.error(
+            "Заказ для курьера %s не отправлен после %s попыток: %s",
+            pizzeria["courier_id"],
+            order["attempts"],
+            order["text"],
+        )
+        db.rpush(
+            FAILED_ORDERS_KEY,
+            json.dumps(
+                {"pizzeria": pizzeria, "order": order}, ensure_ascii=False
+            ),
+        )
+
+
+def take_orders(db, pizzeria_id):
+    """Забирает пачку пиццерии из Redis одной транзакцией"""
+    orders_key = get_orders_key(pizzeria_id)
+    pipeline = db.pipeline()
+    pipeline.lrange(orders_key, 0, -1)
+    pipeline.delete(orders_key)
+    pipeline.hdel(BATCHES_KEY, pizzeria_id)
+    batch, _, _ = pipeline.execute()
+    return [json.loads(item) for item in batch]
+
+
+def flush_orders(bot, db):
+    """Отправляет курьерам пачки, время которых подошло"""
+    now = time.time()
+    for pizzeria_id, due_at in db.hgetall(BATCHES_KEY).items():
+        if float(due_at) > now:
+            continue
+        batch = take_orders(db, pizzeria_id.decode())
+        if not batch:
+            continue
+        pizzeria = batch[-1]["pizzeria"]
+        unsent_orders = send_routes(
+            bot, pizzeria, [item["order"] for item in batch]
+        )
+        retry_orders(db, pizzeria, unsent_orders)
+
+
+def get_coordinates(place):
+    return float(place["latitude"]), float(place["longitude"])
+
+
+def cluster_orders(orders):
+    clusters = []
+    for order in orders:
+        for cluster in clusters:
+            if any(
+                get_distance(get_coordinates(order), get_coordinates(other))
+                <= CLUSTER_RADIUS_KM
+                for other in cluster
+            ):
+                cluster.append(order)
+                break
+        else:
+            clusters.append([order])
+    return clusters
+
+
+def get_route(pizzeria, orders):
+    route = []
+    position = get_coordinates(pizzeria)
+    remaining = list(orders)
+    while remaining:
+        nearest = min(
+            remaining,
+            key=lambda order: get_distance(position, get_coordinates(order)),
+        )
+        remaining.remove(nearest)
+        route.append(nearest)
+        position = get_coordinates(nearest)
+    return route
+
+
+def send_routes(bot, pizzeria, orders):
+    """Отправляет маршруты курьеру. Возвращает заказы, которые не ушли"""
+    courier_id = pizzeria["courier_id"]
+    try:
+        routes = [
+            get_route(pizzeria, cluster) for cluster in cluster_orders(orders)
+        ]
+    except Exception as err:
+        logger.error(
+            "Не удалось построить маршруты пиццерии %s: %s", pizzeria["id"], err
+        )
+        routes = [[order] for order in orders]
+
+    unsent_orders = []
+    for route in routes:
+        try:
+            if len(route) == 1:
+                message = route[0]["text"]
+            else:
+                stops = "\n".join(
+                    f"{stop_number}. {order['text']}"
+                    for stop_number, order in enumerate(route, start=1)
+                )
+                message = f"Маршрут на {len(route)} заказа(ов):\n\n{stops}"
+            bot.send_message(chat_id=courier_id, text=message)
+        except Exception as err:
+            logger.error(
+                "Не удалось отправить маршрут курьеру %s: %s", courier_id, err
+            )
+            unsent_orders.extend(route)
+            continue
+        for order in route:
+            try:
+                latitude, longitude = get_coordinates(order)
+                bot.send_location(
+                    chat_id=courier_id, latitude=latitude, longitude=longitude
+                )
+            except Exception as err:
+                logger.warning(
+                    "Не удалось отправить точку курьеру %s: %s", courier_id, err
+                )
+    return unsent_orders
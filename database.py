@@ -0,0 +1,80 @@
+"""
+Общее подключение к Redis для бота и elasticpath.py.
+
+Все модули работают через один пул соединений. Пул ограничен по размеру:
+когда свободных соединений нет, запрос ждёт освобождения не дольше
+pool_timeout секунд. Таймауты сокета не дают зависшему Redis надолго
+занять обработчик апдейтов.
+"""
+import redis
+from redis.connection import HiredisParser, PythonParser
+from redis.utils import HIREDIS_AVAILABLE
+
+DEFAULT_MAX_CONNECTIONS = 8
+DEFAULT_POOL_TIMEOUT = 5
+DEFAULT_CONNECT_TIMEOUT = 3
+DEFAULT_SOCKET_TIMEOUT = 5
+DEFAULT_HEALTH_CHECK_INTERVAL = 30
+
+_database = None
+
+
+def get_parser_class(parser):
+    """parser: "hiredis", "python" или None — hiredis, если он установлен"""
+    if parser == "python":
+        return PythonParser
+    if parser == "hiredis" and not HIREDIS_AVAILABLE:
+        raise ValueError("Парсер hiredis не установлен: pip install hiredis")
+    if parser in ("hiredis", None) and HIREDIS_AVAILABLE:
+        return HiredisParser
+    return PythonParser
+
+
+def get_database_connection(
+    host,
+    port,
+    password,
+    max_connections=DEFAULT_MAX_CONNECTIONS,
+    pool_timeout=DEFAULT_POOL_TIMEOUT,
+    connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+    socket_timeout=DEFAULT_SOCKET_TIMEOUT,
+    health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL,
+    parser=None,
+):
+    """
+    Возвращает общий клиент Redis. Параметры пула учитываются только
+    при первом вызове, поэтому настраивать его нужно при старте бота.
+    """
+    global _database
+    if _database is None:
+        pool = redis.BlockingConnectionPool(
+            max_connections=max_connections,
+            timeout=pool_timeout,
+            host=host,
+            port=port,
+            password=password,
+            socket_connect_timeout=connect_timeout,
+            socket_timeout=socket_timeout,
+            socket_keepalive=True,
+            health_check_interval=health_check_interval,
+            parser_class=get_parser_class(parser),
+        )
+        _database = redis.Redis(connection_pool=pool)
+    return _database
+
+
+def get_pool_stats():
+    if _database is None:
+        return None
+    pool = _database.connection_pool
+    created = len(pool._connections)
+    idle = sum(
+        1 for connection in list(pool.pool.queue) if connection is not None
+    )
+    return {
+        "max_connections": pool.max_connections,
+        "created": created,
+        "in_use": created - idle,
+        "idle": idle,
+        "parser": pool.connection_kwargs["parser_class"].__name__,
+    }
@@ -0,0 +1,111 @@
+"""
+Дедлайн обработки апдейта.
+
+``start_deadline(seconds)`` задаёт бюджет времени для текущего потока.
+Каждый запрос через transport.session получает таймаут из оставшегося
+бюджета, а если бюджет исчерпан, вызывается DeadlineExceeded. Вне
+апдейта (фоновые потоки) используется DEFAULT_TIMEOUT; работа, которую
+апдейт отдаёт в другой поток, получает его дедлайн через ``bind``.
+
+Таймаут чтения в requests ограничивает каждое чтение из сокета, а не
+весь ответ: если ответ приходит медленно, небольшими частями, запрос
+может закончиться позже дедлайна. Ответы Elastic Path и Yandex
+небольшие, поэтому общий лимит на ответ не вводится.
+"""
+import contextlib
+import functools
+import re
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+CONNECT_TIMEOUT = 3.05
+DEFAULT_TIMEOUT = (CONNECT_TIMEOUT, 15)
+# Таймаут короче этого не считается сбоем эндпоинта в предохранителе:
+# запрос просто получил остаток бюджета, потраченного на другие вызовы
+MIN_FAILURE_TIMEOUT = 2
+
+_local = threading.local()
+_exceeded = Counter()
+_exceeded_lock = threading.Lock()
+
+
+class DeadlineExceeded(Exception):
+    """
+    timeout — таймаут чтения запроса, который не дождался ответа,
+    или None, если бюджет закончился до отправки запроса
+    """
+
+    def __init__(self, endpoint, timeout=None):
+        super().__init__(f"Deadline exceeded before {endpoint}")
+        self.endpoint = endpoint
+        self.timeout = timeout
+
+
+@contextlib.contextmanager
+def start_deadline(seconds):
+    _local.expires_at = time.monotonic() + seconds
+    try:
+        yield
+    finally:
+        _local.expires_at = None
+
+
+def bind(function):
+    """
+    Переносит дедлайн текущего апдейта в функцию, которая выполнится
+    в другом потоке (например, предзагрузка следующей страницы)
+    """
+    expires_at = getattr(_local, "expires_at", None)
+    if expires_at is None:
+        return function
+
+    @functools.wraps(function)
+    def bound_function(*args, **kwargs):
+        _local.expires_at = expires_at
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _local.expires_at = None
+
+    return bound_function
+
+
+def get_remaining():
+    expires_at = getattr(_local, "expires_at", None)
+    if expires_at is None:
+        return None
+    return expires_at - time.monotonic()
+
+
+def get_endpoint(method, url):
+    """Метод и путь запроса, в котором идентификаторы заменены на {id}"""
+    split_url = urlsplit(url)
+    path = "/".join(
+        "{id}"
+        if re.search(r"\d", part) and not re.fullmatch(r"v\d+|\d+\.x", part)
+        else part
+        for part in split_url.path.split("/")
+    )
+    return f"{method.upper()} {split_url.netloc}{path}"
+
+
+def record_exceeded(endpoint):
+    with _exceeded_lock:
+        _exceeded[endpoint] += 1
+
+
+def get_timeout(endpoint):
+    remaining = get_remaining()
+    if remaining is None:
+        return DEFAULT_TIMEOUT
+    if remaining <= 0:
+        record_exceeded(endpoint)
+        raise DeadlineExceeded(endpoint)
+    return min(CONNECT_TIMEOUT, remaining), remaining
+
+
+def get_exceeded_counts():
+    with _exceeded_lock:
+        return dict(_exceeded)
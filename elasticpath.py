@@ -1,16 +1,40 @@
 import json
-
-from slugify import slugify
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 import redis
-
 import requests
 
-_database = None
+import deadline
+import profiler
+from resilience import (
+    circuit_breaker,
+    get_breaker,
+    stale_while_revalidate,
+)
+from transport import session
+
+PRODUCTS_TTL = 300
+IMAGES_TTL = 3600
+PIZZERIAS_TTL = 600
+
+_page_executor = ThreadPoolExecutor(max_workers=4)
+
+_prefetch_executor = ThreadPoolExecutor(max_workers=4)
+_prefetching = set()
+_prefetching_lock = threading.Lock()
+
+_pizzerias_index = (None, {})
 
+logger = logging.getLogger(__name__)
 
-def get_token(client_id: str, client_secret: str, db: redis.Redis) -> str:
-    access_token = db.get("access_token")
+
+def get_token(
+    client_id: str, client_secret: str, db: redis.Redis, refresh: bool = False
+) -> str:
+    access_token = None if refresh else db.get("access_token")
     if not access_token:
         token_url = "https://useast.api.elasticpath.com/oauth/access_token"
         data = {
@@ -18,7 +42,7 @@ def get_token(client_id: str, client_secret: str, db: redis.Redis) -> str:
             "client_secret": client_secret,
             "grant_type": "client_credentials",
         }
-        response = requests.post(token_url, data=data)
+        response = session.post(token_url, data=data)
         response.raise_for_status()
         token_info = response.json()
         time_to_expire = token_info["expires_in"]
@@ -31,49 +55,248 @@ def get_token(client_id: str, client_secret: str, db: redis.Redis) -> str:
     return access_token
 
 
-def get_database_connection(host, port, password):
-    global _database
-    if _database is None:
-        _database = redis.Redis(host=host, port=port, password=password)
-    return _database
+def is_token_rejected(err):
+    return (
+        isinstance(err, requests.exceptions.HTTPError)
+        and err.response is not None
+        and err.response.status_code == 401
+    )
 
 
-def get_products(token):
-    products_url = "https://useast.api.elasticpath.com/pcm/products"
+def get_page(token, url, offset, limit, params=None):
+    """Страница записей; у каждого эндпоинта свой предохранитель"""
+    breaker = get_breaker(deadline.get_endpoint("GET", url))
+    return breaker.call(fetch_page, token, url, offset, limit, params)
+
+
+def fetch_page(token, url, offset, limit, params=None):
     headers = {
         "Authorization": "Bearer {}".format(token),
     }
-    response = requests.get(products_url, headers=headers)
+    page_params = {"page[offset]": offset, "page[limit]": limit}
+    page_params.update(params or {})
+    response = session.get(url, headers=headers, params=page_params)
     response.raise_for_status()
     return response.json()
 
 
-def get_product_by_id(product_id, token):
+def get_updated_at(entry):
+    return entry.get("meta", {}).get("timestamps", {}).get("updated_at")
+
+
+class PageReader:
+    """
+    Лениво отдаёт записи со всех страниц, запрашивая страницы по одной.
+
+    Если prefetch=True, следующая страница запрашивается в фоне, пока
+    обрабатывается текущая. updated_since — курсор (ISO-дата) для
+    инкрементальной синхронизации: отдаются только записи, изменённые
+    после него. После обхода в cursor лежит новый курсор — максимальный
+    entry["meta"]["timestamps"]["updated_at"] среди полученных записей
+    (или updated_since, если новых записей нет). Страницы целиком,
+    вместе с included, отдаёт iter_pages.
+    """
+
+    def __init__(
+        self,
+        token,
+        url,
+        limit=100,
+        prefetch=False,
+        updated_since=None,
+        params=None,
+    ):
+        self.token = token
+        self.url = url
+        self.limit = limit
+        self.prefetch = prefetch
+        self.params = dict(params or {})
+        if updated_since:
+            self.params["filter"] = f"gt(updated_at,{updated_since})"
+        self.cursor = updated_since
+
+    def __iter__(self):
+        for entry in self.iter_entries():
+            updated_at = get_updated_at(entry)
+            if updated_at and (self.cursor is None or updated_at > self.cursor):
+                self.cursor = updated_at
+            yield entry
+
+    def wait_for_page(self, next_page):
+        """Ждёт предзагруженную страницу не дольше дедлайна апдейта"""
+        remaining = deadline.get_remaining()
+        try:
+            return next_page.result(
+                timeout=None if remaining is None else max(remaining, 0)
+            )
+        except FutureTimeoutError:
+            next_page.cancel()
+            endpoint = deadline.get_endpoint("GET", self.url)
+            deadline.record_exceeded(endpoint)
+            raise deadline.DeadlineExceeded(endpoint)
+
+    def iter_entries(self):
+        for page in self.iter_pages():
+            yield from page["data"]
+
+    def iter_pages(self):
+        token, url, limit, params = self.token, self.url, self.limit, self.params
+        offset = 0
+        page = get_page(token, url, offset, limit, params)
+        while True:
+            entries = page["data"]
+            next_page = None
+            if len(entries) == limit:
+                offset += limit
+                if self.prefetch:
+                    fetch_page = deadline.bind(profiler.bind(get_page))
+                    next_page = _page_executor.submit(
+                        fetch_page, token, url, offset, limit, params
+                    )
+            yield page
+
+            if len(entries) < limit:
+                return
+            if next_page is not None:
+                page = self.wait_for_page(next_page)
+            else:
+                page = get_page(token, url, offset, limit, params)
+
+
+def iter_products(token, limit=100, prefetch=False, updated_since=None):
+    products_url = "https://useast.api.elasticpath.com/pcm/products"
+    return PageReader(token, products_url, limit, prefetch, updated_since)
+
+
+def iter_flow_entries(
+    token, slug, limit=100, prefetch=False, updated_since=None
+):
+    url = f"https://useast.api.elasticpath.com/v2/flows/{slug}/entries"
+    return PageReader(token, url, limit, prefetch, updated_since)
+
+
+@stale_while_revalidate(PRODUCTS_TTL)
+def get_products(token):
+    return {"data": list(iter_products(token, prefetch=True))}
+
+
+@stale_while_revalidate(IMAGES_TTL)
+def get_product_image(token, image_id):
     headers = {
         "Authorization": f"Bearer {token}",
     }
-
-    response = requests.get(
-        f"https://useast.api.elasticpath.com/catalog/products/{product_id}",
+    response = session.get(
+        f"https://useast.api.elasticpath.com/v2/files/{image_id}",
         headers=headers,
     )
     response.raise_for_status()
+    return response.json()
 
-    return response.json()["data"]
 
+def get_main_image_links(response_json):
+    main_images = response_json.get("included", {}).get("main_images", [])
+    return {image["id"]: image["link"]["href"] for image in main_images}
 
-def get_product_image(token, image_id):
+
+def get_main_image_id(product):
+    """id главного фото или None, если у товара нет фото"""
+    relationships = product.get("relationships") or {}
+    main_image = (relationships.get("main_image") or {}).get("data")
+    return main_image["id"] if main_image else None
+
+
+@stale_while_revalidate(PRODUCTS_TTL)
+def get_product_card(product_id, token):
+    """
+    Товар и ссылка на его главное фото одним запросом
+    (include=main_image вместо отдельного запроса к /v2/files)
+    """
     headers = {
         "Authorization": f"Bearer {token}",
     }
-    response = requests.get(
-        f"https://useast.api.elasticpath.com/v2/files/{image_id}",
+    response = session.get(
+        f"https://useast.api.elasticpath.com/catalog/products/{product_id}",
         headers=headers,
+        params={"include": "main_image"},
     )
     response.raise_for_status()
-    return response.json()
-
 
+    product = response.json()["data"]
+    image_id = get_main_image_id(product)
+    if image_id is None:
+        return product, None
+    image_url = get_main_image_links(response.json()).get(image_id)
+    if image_url is None:
+        image_url = get_product_image(token, image_id)["data"]["link"]["href"]
+    return product, image_url
+
+
+def get_product_cards(token, limit=100):
+    """
+    Все товары каталога вместе со ссылками на главные фото:
+    один запрос на страницу из limit товаров. У товара без фото
+    ссылка — None. Если фото нет в included, ссылка запрашивается
+    отдельно через /v2/files
+    """
+    url = "https://useast.api.elasticpath.com/catalog/products"
+    pages = PageReader(
+        token, url, limit, prefetch=True, params={"include": "main_image"}
+    )
+    product_cards = {}
+    for page in pages.iter_pages():
+        image_links = get_main_image_links(page)
+        for product in page["data"]:
+            image_id = get_main_image_id(product)
+            if image_id is None:
+                product_cards[product["id"]] = (product, None)
+                continue
+            image_url = image_links.get(image_id)
+            if image_url is None:
+                try:
+                    image_data = get_product_image(token, image_id)["data"]
+                    image_url = image_data["link"]["href"]
+                except Exception as err:
+                    logger.warning(
+                        "Нет фото %s товара %s: %s",
+                        image_id,
+                        product["id"],
+                        err,
+                    )
+                    continue
+            product_cards[product["id"]] = (product, image_url)
+    return product_cards
+
+
+def prefetch_product_cards(token):
+    try:
+        for product_id, product_card in get_product_cards(token).items():
+            get_product_card.store(product_card, product_id, token)
+    except Exception as err:
+        logger.warning("Не удалось загрузить каталог: %s", err)
+    finally:
+        with _prefetching_lock:
+            _prefetching.discard("catalog")
+
+
+def prefetch_products(token, product_ids):
+    """
+    Заранее загружает в кэш карточки товаров со ссылками на фото,
+    не блокируя вызывающий поток. Если все карточки уже в кэше или
+    каталог загружается по запросу из другого чата, ничего не делает.
+    """
+    if all(
+        get_product_card.is_fresh(product_id, token)
+        for product_id in product_ids
+    ):
+        return
+    with _prefetching_lock:
+        if "catalog" in _prefetching:
+            return
+        _prefetching.add("catalog")
+    _prefetch_executor.submit(profiler.bind(prefetch_product_cards), token)
+
+
+@circuit_breaker
 def create_cart(token):
     carts_url = "https://useast.api.elasticpath.com/v2/carts"
     headers = {
@@ -85,12 +308,13 @@ def create_cart(token):
             "name": "test",
         }
     }
-    response = requests.post(carts_url, headers=headers, json=data)
+    response = session.post(carts_url, headers=headers, json=data)
     response.raise_for_status()
     return response.json()["data"]["id"]
 
 
-def add_product_to_cart(cart_id, token, product):
+@circuit_breaker
+def add_product_to_cart(cart_id, token, product, quantity=1):
     cart_url = f"https://useast.api.elasticpath.com/v2/carts/{cart_id}/items/"
     headers = {
         "Authorization": "Bearer {}".format(token),
@@ -100,39 +324,42 @@ def add_product_to_cart(cart_id, token, product):
         "data": {
             "id": product,
             "type": "cart_item",
-            "quantity": 1,
+            "quantity": quantity,
         }
     }
-    response = requests.post(cart_url, headers=headers, json=data)
+    response = session.post(cart_url, headers=headers, json=data)
     response.raise_for_status()
     return response.json()
 
 
+@circuit_breaker
 def get_cart(token, chat_id):
     cart_url = f"https://useast.api.elasticpath.com/v2/carts/{chat_id}/items"
     headers = {
         "Authorization": "Bearer {}".format(token),
     }
-    response = requests.get(cart_url, headers=headers)
+    response = session.get(cart_url, headers=headers)
     response.raise_for_status()
     return response.json()["data"]
 
 
+@circuit_breaker
 def delete_product_from_cart(token, product_id, chat_id):
     url = f"https://useast.api.elasticpath.com/v2/carts/{chat_id}/items/{product_id}"
     headers = {
         "Authorization": "Bearer {}".format(token),
     }
-    response = requests.delete(url, headers=headers)
+    response = session.delete(url, headers=headers)
     response.raise_for_status()
 
 
+@circuit_breaker
 def get_carts_sum(token, chat_id):
     carts_sum_url = f"https://useast.api.elasticpath.com/v2/carts/{chat_id}"
     headers = {
         "Authorization": "Bearer {}".format(token),
     }
-    response = requests.get(carts_sum_url, headers=headers)
+    response = session.get(carts_sum_url, headers=headers)
     response.raise_for_status()
     carts_sum = response.json()["data"]["meta"]["display_price"]["with_tax"]["formatted"]
     payment_sum = response.json()["data"]["meta"]["display_price"]["with_tax"]["amount"]
@@ -140,6 +367,7 @@ def get_carts_sum(token, chat_id):
     return carts_sum, payment_sum
 
 
+@circuit_breaker
 def create_customer(token, email, chat_id):
     url = f"https://useast.api.elasticpath.com/v2/customers"
     headers = {
@@ -154,7 +382,7 @@ def create_customer(token, email, chat_id):
             "password": "",
         },
     }
-    response = requests.post(url, headers=headers, json=json_data)
+    response = session.post(url, headers=headers, json=json_data)
     response.raise_for_status()
 
 
@@ -164,7 +392,7 @@ def load_file(token, image_url):
     }
     url = "https://useast.api.elasticpath.com/v2/files"
     files = {"file_location": (None, image_url)}
-    load_file_response = requests.post(url, headers=headers, files=files)
+    load_file_response = session.post(url, headers=headers, files=files)
     load_file_response.raise_for_status()
     return load_file_response
 
@@ -181,7 +409,7 @@ def add_file_to_product(token, product_id, image_id):
         },
     }
     url = f"https://useast.api.elasticpath.com/pcm/products/{product_id}/relationships/main_image"
-    response = requests.post(url, headers=headers, json=json_data)
+    response = session.post(url, headers=headers, json=json_data)
     response.raise_for_status()
 
 
@@ -199,7 +427,7 @@ def add_pricebook(token):
             },
         },
     }
-    response = requests.post(
+    response = session.post(
         "https://useast.api.elasticpath.com/pcm/pricebooks",
         headers=headers,
         json=json_data,
@@ -226,7 +454,7 @@ def create_currency(token):
             "enabled": True,
         }
     }
-    response = requests.post(url, headers=headers, json=json_data)
+    response = session.post(url, headers=headers, json=json_data)
     response.raise_for_status()
 
 
@@ -247,11 +475,13 @@ def add_price_for_product(token, pricebook_id, product_sku, product_price):
             },
         }
     }
-    response = requests.post(url, headers=headers, json=json_data)
+    response = session.post(url, headers=headers, json=json_data)
     response.raise_for_status()
 
 
 def add_products(token):
+    from slugify import slugify
+
     headers = {
         "Authorization": "Bearer {}".format(token),
         "Content-Type": "application/json",
@@ -275,7 +505,7 @@ def add_products(token):
                 },
             }
         }
-        response = requests.post(
+        response = session.post(
             "https://useast.api.elasticpath.com/pcm/products",
             headers=headers,
             json=json_data,
@@ -316,7 +546,7 @@ def add_pizzeria_address(token, slug="pizzeri-aaddresses"):
                 "latitude": float(address["coordinates"]["lat"]),
             }
         }
-        response = requests.post(
+        response = session.post(
             f"https://useast.api.elasticpath.com/v2/flows/{slug}/entries",
             headers=headers,
             json=json_data,
@@ -324,6 +554,7 @@ def add_pizzeria_address(token, slug="pizzeri-aaddresses"):
         response.raise_for_status()
 
 
+@circuit_breaker
 def add_customer_address(
     token, customer_id, latitude, longitude, slug="customer-address"
 ):
@@ -340,7 +571,7 @@ def add_customer_address(
         }
     }
 
-    response = requests.post(
+    response = session.post(
         f"https://useast.api.elasticpath.com/v2/flows/{slug}/entries",
         headers=headers,
         json=json_data,
@@ -350,6 +581,8 @@ def add_customer_address(
 
 
 def create_flow(token, name, description):
+    from slugify import slugify
+
     headers = {
         "Authorization": "Bearer {}".format(token),
         "Content-Type": "application/json",
@@ -363,7 +596,7 @@ def create_flow(token, name, description):
             "enabled": True,
         },
     }
-    response = requests.post(
+    response = session.post(
         "https://useast.api.elasticpath.com/v2/flows",
         headers=headers,
         json=json_data,
@@ -373,6 +606,8 @@ def create_flow(token, name, description):
 
 
 def create_field(token, flow_id, field_name, field_type):
+    from slugify import slugify
+
     url = "https://useast.api.elasticpath.com/v2/fields"
     headers = {
         "Authorization": "Bearer {}".format(token),
@@ -392,36 +627,51 @@ def create_field(token, flow_id, field_name, field_type):
             },
         }
     }
-    response = requests.post(url, headers=headers, json=data)
+    response = session.post(url, headers=headers, json=data)
     response.raise_for_status()
     return response.json()
 
 
+@stale_while_revalidate(PIZZERIAS_TTL)
 def get_all_pizzerias(token, slug="pizzeri-aaddresses"):
-    url = f"https://useast.api.elasticpath.com/v2/flows/{slug}/entries?page[limit]=100"
-
-    headers = {
-        "Authorization": "Bearer {}".format(token),
-    }
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    return response.json()
-
-
+    return {"data": list(iter_flow_entries(token, slug, prefetch=True))}
+
+
+def get_pizzeria(token, pizzeria_id):
+    """
+    Пиццерия по id из кэшированного списка get_all_pizzerias. Индекс
+    по id перестраивается, когда в кэше появляется новый список
+    """
+    global _pizzerias_index
+    pizzerias = get_all_pizzerias(token)["data"]
+    indexed_pizzerias, pizzerias_by_id = _pizzerias_index
+    if indexed_pizzerias is not pizzerias:
+        pizzerias_by_id = {pizzeria["id"]: pizzeria for pizzeria in pizzerias}
+        _pizzerias_index = (pizzerias, pizzerias_by_id)
+    pizzeria = pizzerias_by_id.get(pizzeria_id)
+    if pizzeria is None:
+        pizzeria = get_entries_by_id(
+            token, entry_id=pizzeria_id, flow_slug="pizzeri-aaddresses"
+        )["data"]
+    return pizzeria
+
+
+@circuit_breaker
 def get_entries_by_id(token, entry_id, flow_slug):
     url = f"https://useast.api.elasticpath.com/v2/flows/{flow_slug}/entries/{entry_id}"
     headers = {
         "Authorization": "Bearer {}".format(token),
     }
-    response = requests.get(url, headers=headers)
+    response = session.get(url, headers=headers)
     response.raise_for_status()
     return response.json()
 
 
+@circuit_breaker
 def delete_all_cart_products(token, chat_id):
     url = f"https://useast.api.elasticpath.com/v2/carts/{chat_id}/items"
     headers = {
         "Authorization": "Bearer {}".format(token),
     }
-    response = requests.delete(url, headers=headers)
+    response = session.delete(url, headers=headers)
     response.raise_for_status()
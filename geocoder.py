@@ -1,10 +1,11 @@
 import requests
-from geopy import distance
+
+from transport import session
 
 
 def fetch_coordinates(api_key, address):
     base_url = "https://geocode-maps.yandex.ru/1.x"
-    response = requests.get(
+    response = session.get(
         base_url,
         params={
             "geocode": address,
@@ -38,6 +39,8 @@ def get_coordinates(api_key, address):
 
 
 def get_distance(customer_coordinates, restaurant_coordinates):
+    from geopy import distance
+
     if all([*customer_coordinates, *restaurant_coordinates]):
         distance_between = round(
             distance.distance(customer_coordinates, restaurant_coordinates).km,
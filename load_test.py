@@ -0,0 +1,638 @@
+"""
+Нагрузочный тест бота: N виртуальных чатов проходят весь сценарий заказа
+от /start до оплаты через handle_users_reply.
+
+Elastic Path, Yandex, Redis и Telegram заменены локальными заглушками
+с настраиваемой задержкой, поэтому тест не ходит во внешние сервисы.
+
+Пример запуска:
+
+    python3 load_test.py --chats 200 --rate 20 --think-time 0.5
+"""
+import argparse
+import itertools
+import json
+import logging
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from urllib.parse import parse_qsl, urlsplit
+
+from redis.exceptions import DataError
+from requests.adapters import BaseAdapter
+from telegram import Update
+
+import database
+import tg_bot
+import transport
+
+
+class StandInBackend:
+    """
+    Упрощённая реализация тех эндпоинтов Elastic Path и Yandex,
+    которые использует бот. Данные берутся из example_menu.json
+    и example_addresses.json. Ответ — пара (HTTP-статус, JSON).
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.entry_ids = itertools.count(1)
+
+        with open("example_menu.json", "r") as my_file:
+            menu = json.load(my_file)
+        self.products = {
+            f"product-{product['id']}": {
+                "name": product["name"],
+                "description": product["description"],
+                "price": product["price"],
+            }
+            for product in menu
+        }
+
+        with open("example_addresses.json", "r") as my_file:
+            addresses = json.load(my_file)
+        self.flows = {
+            "pizzeri-aaddresses": {
+                address["id"]: {
+                    "id": address["id"],
+                    "address": address["address"]["full"],
+                    "alias": address["alias"],
+                    "latitude": float(address["coordinates"]["lat"]),
+                    "longitude": float(address["coordinates"]["lon"]),
+                    "courier-telegram-id": 1,
+                }
+                for address in addresses
+            },
+            "customer-address": {},
+        }
+        self.carts = defaultdict(dict)
+
+    def request(self, method, url, body=None):
+        if self.latency:
+            time.sleep(random.expovariate(1 / self.latency))
+        split_url = urlsplit(url)
+        path = [part for part in split_url.path.split("/") if part]
+        params = dict(parse_qsl(split_url.query))
+        try:
+            json_data = json.loads(body)
+        except (TypeError, ValueError):
+            json_data = None
+        with self.lock:
+            if split_url.netloc == "geocode-maps.yandex.ru":
+                return self.geocode()
+            return self.route(method, path, params, json_data)
+
+    def route(self, method, path, params, json_data):
+        if path == ["oauth", "access_token"]:
+            return (
+                200, {"access_token": "stand-in-token", "expires_in": 3600}
+            )
+        if path == ["pcm", "products"]:
+            products = [
+                {"id": product_id, "attributes": product}
+                for product_id, product in self.products.items()
+            ]
+            return self.page(products, params)
+        if path == ["catalog", "products"]:
+            status_code, payload = self.page(
+                [self.product(product_id) for product_id in self.products],
+                params,
+            )
+            if params.get("include") == "main_image":
+                payload["included"] = {
+                    "main_images": [
+                        self.image(get_image_id(product["id"]))
+                        for product in payload["data"]
+                    ]
+                }
+            return status_code, payload
+        if path[:2] == ["catalog", "products"]:
+            if path[2] not in self.products:
+                return 404, None
+            payload = {"data": self.product(path[2])}
+            if params.get("include") == "main_image":
+                payload["included"] = {
+                    "main_images": [self.image(get_image_id(path[2]))]
+                }
+            return 200, payload
+        if path[:2] == ["v2", "files"]:
+            return 200, {"data": self.image(path[2])}
+        if path[:2] == ["v2", "carts"]:
+            return self.cart(method, path[2:], json_data)
+        if path == ["v2", "customers"]:
+            return 201, {"data": {}}
+        if path[:2] == ["v2", "flows"] and path[3:4] == ["entries"]:
+            return self.flow_entries(method, path[2], path[4:], params, json_data)
+        return 404, None
+
+    def page(self, entries, params):
+        offset = int(params.get("page[offset]", 0))
+        limit = int(params.get("page[limit]", 100))
+        return 200, {"data": entries[offset:offset + limit]}
+
+    def product(self, product_id):
+        product = self.products[product_id]
+        return {
+            "id": product_id,
+            "attributes": {
+                "name": product["name"],
+                "description": product["description"],
+            },
+            "meta": {
+                "display_price": {
+                    "without_tax": {
+                        "formatted": f"{product['price']} РУБ",
+                    },
+                },
+            },
+            "relationships": {
+                "main_image": {"data": {"id": get_image_id(product_id)}},
+            },
+        }
+
+    def image(self, image_id):
+        return {
+            "id": image_id,
+            "link": {"href": f"https://example.com/{image_id}.jpg"},
+        }
+
+    def cart(self, method, path, json_data):
+        cart = self.carts[path[0]]
+        if method == "GET" and len(path) == 1:
+            amount = sum(
+                self.products[product_id]["price"] * 100 * quantity
+                for product_id, quantity in cart.items()
+            )
+            return (
+                200,
+                {
+                    "data": {
+                        "meta": {
+                            "display_price": {
+                                "with_tax": {
+                                    "formatted": f"{amount / 100} РУБ",
+                                    "amount": amount,
+                                },
+                            },
+                        },
+                    },
+                },
+            )
+        if method == "GET":
+            items = [
+                {
+                    "id": product_id,
+                    "product_id": product_id,
+                    "name": self.products[product_id]["name"],
+                    "description": self.products[product_id]["description"],
+                    "quantity": quantity,
+                    "meta": {
+                        "display_price": {
+                            "without_tax": {
+                                "unit": {
+                                    "formatted": f"{self.products[product_id]['price']} РУБ",
+                                },
+                            },
+                        },
+                    },
+                }
+                for product_id, quantity in cart.items()
+            ]
+            return 200, {"data": items}
+        if method == "POST":
+            product_id = json_data["data"]["id"]
+            quantity = json_data["data"]["quantity"]
+            cart[product_id] = cart.get(product_id, 0) + quantity
+            return 201, {"data": []}
+        if method == "DELETE" and len(path) == 3:
+            cart.pop(path[2], None)
+        else:
+            cart.clear()
+        return 200, {"data": []}
+
+    def flow_entries(self, method, slug, path, params, json_data):
+        entries = self.flows[slug]
+        if method == "POST":
+            entry = dict(json_data["data"], id=f"entry-{next(self.entry_ids)}")
+            entries[entry["id"]] = entry
+            return 201, {"data": entry}
+        if path:
+            return 200, {"data": entries[path[0]]}
+        return self.page(list(entries.values()), params)
+
+    def geocode(self):
+        pizzeria = random.choice(list(self.flows["pizzeri-aaddresses"].values()))
+        position = f"{pizzeria['longitude']} {pizzeria['latitude']}"
+        return (
+            200,
+            {
+                "response": {
+                    "GeoObjectCollection": {
+                        "featureMember": [
+                            {"GeoObject": {"Point": {"pos": position}}}
+                        ]
+                    }
+                }
+            },
+        )
+
+
+def get_image_id(product_id):
+    return f"image-{product_id}"
+
+
+class StandInAdapter(BaseAdapter):
+    """Адаптер для transport.session, отвечающий из StandInBackend"""
+
+    def __init__(self, backend):
+        super().__init__()
+        self.backend = backend
+
+    def send(self, request, **kwargs):
+        status_code, payload = self.backend.request(
+            request.method, request.url, request.body
+        )
+        return transport.build_response(
+            request, status_code, json.dumps(payload), "application/json"
+        )
+
+    def close(self):
+        pass
+
+
+class StandInRedis:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.json_values = {}
+        self.streams = {}
+        self.lists = defaultdict(list)
+        self.hashes = defaultdict(dict)
+        self.pipeline_lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self.values.get(str(key))
+
+    def set(self, key, value, ex=None):
+        if value is None:
+            raise DataError("Invalid input of type: 'NoneType'")
+        with self.lock:
+            self.values[str(key)] = str(value).encode()
+
+    def delete(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.values.pop(str(key), None)
+                self.lists.pop(str(key), None)
+
+    def pipeline(self):
+        return StandInPipeline(self)
+
+    def rpush(self, key, *values):
+        with self.lock:
+            self.lists[key].extend(str(value).encode() for value in values)
+
+    def lrange(self, key, start, end):
+        with self.lock:
+            values = self.lists.get(key, [])
+            return list(values[start:end + 1 if end != -1 else None])
+
+    def hsetnx(self, name, key, value):
+        with self.lock:
+            self.hashes[name].setdefault(str(key), str(value).encode())
+
+    def hdel(self, name, *keys):
+        with self.lock:
+            for key in keys:
+                self.hashes[name].pop(str(key), None)
+
+    def hgetall(self, name):
+        with self.lock:
+            return {
+                key.encode(): value
+                for key, value in self.hashes.get(name, {}).items()
+            }
+
+    def json(self):
+        return SimpleNamespace(get=self.json_get, set=self.json_set)
+
+    def xadd(self, name, fields, maxlen=None, approximate=True):
+        with self.lock:
+            self.streams.setdefault(name, []).append(fields)
+
+    def json_get(self, key):
+        with self.lock:
+            return self.json_values.get(key)
+
+    def json_set(self, key, path, value):
+        with self.lock:
+            self.json_values[key] = value
+
+
+class StandInPipeline:
+    """Заглушка redis pipeline: команды выполняются вместе при execute"""
+
+    def __init__(self, db):
+        self.db = db
+        self.commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+
+        def queue_command(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+
+        return queue_command
+
+    def execute(self):
+        with self.db.pipeline_lock:
+            return [
+                method(*args, **kwargs)
+                for method, args, kwargs in self.commands
+            ]
+
+
+class StandInBot:
+    """Заглушка telegram.Bot: отвечает с задержкой, ничего не отправляя"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.message_ids = itertools.count(1)
+
+    def _call(self, *args, **kwargs):
+        if self.latency:
+            time.sleep(random.expovariate(1 / self.latency))
+        return SimpleNamespace(message_id=next(self.message_ids))
+
+    send_message = _call
+    send_photo = _call
+    send_location = _call
+    edit_message_text = _call
+    edit_message_reply_markup = _call
+    answer_callback_query = _call
+    answer_pre_checkout_query = _call
+    sendInvoice = _call
+
+
+class ErrorCounter(logging.Handler):
+    """Считает ошибки, залогированные обработчиком в текущем потоке"""
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.local = threading.local()
+
+    def reset(self):
+        self.local.errors = 0
+
+    def emit(self, record):
+        self.local.errors = getattr(self.local, "errors", 0) + 1
+
+
+def make_user(chat_id):
+    return {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"}
+
+
+def make_message(chat_id, **fields):
+    message = {
+        "message_id": random.randint(1, 10 ** 6),
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": make_user(chat_id),
+    }
+    message.update(fields)
+    return message
+
+
+def make_text_update(bot, update_id, chat_id, text):
+    return Update.de_json(
+        {"update_id": update_id, "message": make_message(chat_id, text=text)},
+        bot,
+    )
+
+
+def make_location_update(bot, update_id, chat_id, latitude, longitude):
+    location = {"latitude": latitude, "longitude": longitude}
+    return Update.de_json(
+        {
+            "update_id": update_id,
+            "message": make_message(chat_id, location=location),
+        },
+        bot,
+    )
+
+
+def make_callback_update(bot, update_id, chat_id, data):
+    return Update.de_json(
+        {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": make_user(chat_id),
+                "chat_instance": str(chat_id),
+                "data": data,
+                "message": make_message(chat_id, text="stand-in"),
+            },
+        },
+        bot,
+    )
+
+
+def get_order_steps(backend, chat_id):
+    """
+    Шаги сценария заказа: (состояние, тип апдейта, данные, ожидаемое
+    состояние после обработки). None — состояние не проверяется.
+    """
+    product_id = random.choice(list(backend.products))
+    pizzeria = random.choice(list(backend.flows["pizzeri-aaddresses"].values()))
+    latitude = pizzeria["latitude"] + random.uniform(-0.02, 0.02)
+    longitude = pizzeria["longitude"] + random.uniform(-0.02, 0.02)
+
+    steps = [
+        ("START", "text", "/start", "HANDLE_MENU"),
+        ("HANDLE_MENU", "callback", product_id, "HANDLE_DESCRIPTION"),
+    ]
+    for _ in range(random.randint(1, 3)):
+        steps.append(
+            (
+                "HANDLE_DESCRIPTION",
+                "callback",
+                f"add_to_cart, {product_id}",
+                "HANDLE_DESCRIPTION",
+            )
+        )
+    steps += [
+        ("HANDLE_DESCRIPTION", "callback", "cart", "HANDLE_CART"),
+        ("HANDLE_CART", "callback", "order", "WAITING_EMAIL"),
+        (
+            "WAITING_EMAIL",
+            "text",
+            f"user{chat_id}@example.com",
+            "WAITING_LOCATION",
+        ),
+        (
+            "WAITING_LOCATION",
+            "location",
+            (latitude, longitude),
+            "WAITING_PIZZA",
+        ),
+        ("WAITING_PIZZA", "callback", "delivery", "WAITING_PAYMENT"),
+        ("WAITING_PAYMENT", "callback", "payment", None),
+    ]
+    return steps
+
+
+def validate_email_stand_in(email):
+    return "@" in email
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.backend = StandInBackend(latency=args.backend_latency)
+        self.db = StandInRedis()
+        self.bot = StandInBot(latency=args.telegram_latency)
+        self.executor = ThreadPoolExecutor(max_workers=args.workers)
+        self.error_counter = ErrorCounter()
+        self.update_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.completed_orders = 0
+
+    def install_stand_ins(self):
+        transport.mount(StandInAdapter(self.backend))
+
+        self.db.set("access_token", "stand-in-token")
+        database._database = self.db
+        tg_bot.is_valid_email = validate_email_stand_in
+        logging.getLogger().addHandler(self.error_counter)
+
+    def handle_update(self, update):
+        self.error_counter.reset()
+        tg_bot.handle_users_reply(
+            self.bot,
+            update,
+            host=None,
+            port=None,
+            password=None,
+            client_id="stand-in",
+            client_secret="stand-in",
+            provider_token="stand-in",
+            yandex_api_key="stand-in",
+        )
+        return self.error_counter.local.errors
+
+    def make_update(self, chat_id, kind, payload):
+        update_id = next(self.update_ids)
+        if kind == "text":
+            return make_text_update(self.bot, update_id, chat_id, payload)
+        if kind == "location":
+            return make_location_update(self.bot, update_id, chat_id, *payload)
+        return make_callback_update(self.bot, update_id, chat_id, payload)
+
+    def run_chat(self, chat_id):
+        for state, kind, payload, expected_state in get_order_steps(
+            self.backend, chat_id
+        ):
+            update = self.make_update(chat_id, kind, payload)
+            started_at = time.perf_counter()
+            try:
+                errors = self.executor.submit(self.handle_update, update).result()
+            except Exception:
+                errors = 1
+            latency = time.perf_counter() - started_at
+
+            actual_state = self.db.get(chat_id)
+            if expected_state and actual_state != expected_state.encode():
+                errors += 1
+            with self.lock:
+                self.latencies[state].append(latency)
+                if errors:
+                    self.errors[state] += 1
+            if errors:
+                return
+            if self.args.think_time:
+                time.sleep(random.expovariate(1 / self.args.think_time))
+
+        with self.lock:
+            self.completed_orders += 1
+
+    def run(self):
+        self.install_stand_ins()
+        chats = []
+        started_at = time.perf_counter()
+        for chat_id in range(1, self.args.chats + 1):
+            chat = threading.Thread(target=self.run_chat, args=(chat_id,))
+            chat.start()
+            chats.append(chat)
+            time.sleep(random.expovariate(self.args.rate))
+        for chat in chats:
+            chat.join()
+        duration = time.perf_counter() - started_at
+        self.executor.shutdown()
+        self.print_report(duration)
+
+    def print_report(self, duration):
+        total_updates = sum(len(latencies) for latencies in self.latencies.values())
+        print(f"Чатов: {self.args.chats}, длительность: {duration:.1f} с")
+        print(
+            f"Апдейтов: {total_updates} ({total_updates / duration:.1f}/с), "
+            f"заказов: {self.completed_orders} "
+            f"({self.completed_orders / duration:.2f}/с)"
+        )
+        print()
+        print(
+            f"{'state':<20}{'count':>8}{'errors':>8}{'err %':>8}"
+            f"{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+        )
+        for state, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            errors = self.errors[state]
+            print(
+                f"{state:<20}{len(latencies):>8}{errors:>8}"
+                f"{errors / len(latencies) * 100:>8.1f}"
+                f"{get_percentile(latencies, 50) * 1000:>10.1f}"
+                f"{get_percentile(latencies, 90) * 1000:>10.1f}"
+                f"{get_percentile(latencies, 99) * 1000:>10.1f}"
+                f"{latencies[-1] * 1000:>10.1f}"
+            )
+
+
+def get_percentile(sorted_values, percent):
+    index = max(math.ceil(len(sorted_values) * percent / 100) - 1, 0)
+    return sorted_values[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Нагрузочный тест сценария заказа пиццы"
+    )
+    parser.add_argument("--chats", type=int, default=50,
+                        help="количество виртуальных чатов")
+    parser.add_argument("--rate", type=float, default=5.0,
+                        help="новых чатов в секунду")
+    parser.add_argument("--think-time", type=float, default=1.0,
+                        help="среднее время между действиями пользователя, с")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="потоков обработки апдейтов (диспетчер "
+                             "python-telegram-bot обрабатывает апдейты "
+                             "последовательно)")
+    parser.add_argument("--backend-latency", type=float, default=0.05,
+                        help="средняя задержка Elastic Path и Yandex, с")
+    parser.add_argument("--telegram-latency", type=float, default=0.03,
+                        help="средняя задержка Telegram Bot API, с")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    LoadTest(args).run()
+
+
+if __name__ == "__main__":
+    main()
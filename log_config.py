@@ -0,0 +1,113 @@
+"""
+Настройка логирования бота.
+
+В режиме ``async`` обработчик апдейта только кладёт запись в очередь,
+а форматирует и пишет её фоновый поток (QueueListener). DEBUG-записи
+каждого логгера ограничены по частоте, остальные уровни проходят все.
+К каждой записи добавляются chat_id и state текущего апдейта, в формате
+``json`` они выводятся отдельными полями.
+"""
+import atexit
+import contextlib
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+TEXT_FORMAT = (
+    "%(asctime)s - %(name)s - %(levelname)s - "
+    "[chat_id=%(chat_id)s state=%(state)s] %(message)s"
+)
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def update_context(chat_id):
+    context = {"chat_id": chat_id, "state": None}
+    _local.context = context
+    try:
+        yield context
+    finally:
+        _local.context = None
+
+
+class UpdateContextFilter(logging.Filter):
+    def filter(self, record):
+        context = getattr(_local, "context", None) or {}
+        record.chat_id = context.get("chat_id")
+        record.state = context.get("state")
+        return True
+
+
+class DebugRateLimitFilter(logging.Filter):
+    """Пропускает не больше max_per_second DEBUG-записей каждого логгера"""
+
+    def __init__(self, max_per_second):
+        super().__init__()
+        self.max_per_second = max_per_second
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        current_second = int(time.monotonic())
+        with self.lock:
+            window_second, count = self.windows.get(record.name, (None, 0))
+            if window_second != current_second:
+                window_second, count = current_second, 0
+            self.windows[record.name] = (window_second, count + 1)
+        return count < self.max_per_second
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "chat_id": getattr(record, "chat_id", None),
+            "state": getattr(record, "state", None),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Кладёт запись в очередь как есть: форматирует её уже слушатель"""
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(
+    mode="async", level=logging.INFO, log_format="text", debug_per_second=5
+):
+    output_handler = logging.StreamHandler()
+    if log_format == "json":
+        output_handler.setFormatter(JsonFormatter())
+    else:
+        output_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    if mode == "async":
+        records_queue = queue.SimpleQueue()
+        handler = DeferredQueueHandler(records_queue)
+        listener = logging.handlers.QueueListener(
+            records_queue, output_handler
+        )
+        listener.start()
+        atexit.register(listener.stop)
+    else:
+        handler = output_handler
+
+    handler.addFilter(UpdateContextFilter())
+    handler.addFilter(DebugRateLimitFilter(debug_per_second))
+
+    root_logger = logging.getLogger()
+    root_logger.handlers = [handler]
+    root_logger.setLevel(level)
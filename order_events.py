@@ -0,0 +1,120 @@
+"""
+Журнал событий заказов в Redis Stream.
+
+Бот дописывает в поток ``order_events`` переходы между состояниями
+(завершение диалога — переход в "END"), выбор доставки и оплаченные
+заказы (товары, сумма, пиццерия, расстояние). Заказ попадает в поток
+только после successful_payment от Telegram. Отчёты строятся по потоку, без запросов к Elastic Path.
+
+``OrderStats`` читает поток с того места, где остановился, и
+инкрементально считает заказы и выручку по пиццериям за каждый час.
+Запуск консьюмера, который печатает статистику:
+
+    python3 order_events.py
+"""
+import json
+import logging
+import os
+import time
+from collections import Counter
+
+STREAM_KEY = "order_events"
+STREAM_MAXLEN = 100000
+
+logger = logging.getLogger(__name__)
+
+
+def append_event(db, event_type, chat_id, **data):
+    try:
+        db.xadd(
+            STREAM_KEY,
+            {
+                "type": event_type,
+                "chat_id": str(chat_id),
+                "time": str(time.time()),
+                "data": json.dumps(data, ensure_ascii=False),
+            },
+            maxlen=STREAM_MAXLEN,
+            approximate=True,
+        )
+    except Exception as err:
+        logger.warning("Не удалось записать событие %s: %s", event_type, err)
+
+
+class OrderStats:
+    def __init__(self, db, window_hours=24):
+        self.db = db
+        self.window_hours = window_hours
+        self.last_id = "0-0"
+        self.orders = Counter()
+        self.revenue = Counter()
+        self.transitions = Counter()
+
+    def apply(self, fields):
+        event_type = fields[b"type"].decode()
+        data = json.loads(fields[b"data"])
+        if event_type == "transition":
+            self.transitions[(data["from_state"], data["to_state"])] += 1
+        elif event_type == "order_completed":
+            hour = int(float(fields[b"time"])) // 3600 * 3600
+            self.orders[(data["pizzeria_id"], hour)] += 1
+            self.revenue[(data["pizzeria_id"], hour)] += data["sum"]
+
+    def prune(self):
+        oldest_hour = (int(time.time()) // 3600 - self.window_hours) * 3600
+        for counter in (self.orders, self.revenue):
+            for pizzeria_id, hour in list(counter):
+                if hour < oldest_hour:
+                    del counter[(pizzeria_id, hour)]
+
+    def poll(self, count=1000, block=None):
+        """Читает новые события и возвращает их количество"""
+        response = self.db.xread(
+            {STREAM_KEY: self.last_id}, count=count, block=block
+        )
+        events_count = 0
+        for _, entries in response:
+            for entry_id, fields in entries:
+                self.apply(fields)
+                self.last_id = entry_id
+                events_count += 1
+        self.prune()
+        return events_count
+
+    def get_orders_per_hour(self):
+        """{(пиццерия, час): (заказов, выручка в копейках)} по времени"""
+        report = {}
+        for (pizzeria_id, hour), orders in sorted(
+            self.orders.items(), key=lambda item: item[0][1]
+        ):
+            hour_label = time.strftime("%Y-%m-%d %H:00", time.localtime(hour))
+            report[(pizzeria_id, hour_label)] = (
+                orders,
+                self.revenue[(pizzeria_id, hour)],
+            )
+        return report
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    from database import get_database_connection
+
+    load_dotenv()
+    db = get_database_connection(
+        os.environ["DATABASE_HOST"],
+        os.environ["DATABASE_PORT"],
+        os.environ["DATABASE_PASSWORD"],
+        socket_timeout=None,
+    )
+    stats = OrderStats(db)
+    while True:
+        if stats.poll(block=5000):
+            for (pizzeria_id, hour), (orders, revenue) in (
+                stats.get_orders_per_hour().items()
+            ):
+                print(
+                    f"{hour}  {pizzeria_id}: {orders} заказ(ов), "
+                    f"{revenue / 100:.2f} руб."
+                )
+            print()
@@ -0,0 +1,197 @@
+"""
+Профилирование медленных апдейтов.
+
+Если профилирование включено (``enable``), для каждого апдейта
+собирается трасса: состояние, обработчик, длительность и ошибка каждого
+вызова Elastic Path, Yandex, Redis и Telegram, включая таймауты. Трассы
+апдейтов, которые обрабатывались дольше порога, складываются в кольцевой
+буфер и выгружаются в JSON через ``dump_traces``. Часть апдейтов можно
+дополнительно профилировать через cProfile.
+
+Когда профилирование выключено, ``profile_update`` возвращает один и тот
+же пустой объект, и накладные расходы сводятся к одной проверке флага.
+"""
+import functools
+import io
+import json
+import random
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+import transport
+
+_enabled = False
+_threshold = 1.0
+_cprofile_sample_rate = 0.0
+_traces = deque(maxlen=100)
+_local = threading.local()
+
+
+def enable(threshold=1.0, buffer_size=100, cprofile_sample_rate=0.0):
+    global _enabled, _threshold, _cprofile_sample_rate, _traces
+    _threshold = threshold
+    _cprofile_sample_rate = cprofile_sample_rate
+    _traces = deque(_traces, maxlen=buffer_size)
+    if not _enabled:
+        transport.session.call_hooks.append(record_http_call)
+    _enabled = True
+
+
+def record_call(kind, name, duration, error=None):
+    trace = getattr(_local, "trace", None)
+    if trace is None:
+        return
+    call = {"kind": kind, "name": name, "duration": round(duration, 4)}
+    if error is not None:
+        call["error"] = repr(error)
+    if getattr(_local, "background", False):
+        call["background"] = True
+    trace["calls"].append(call)
+
+
+def record_http_call(method, url, duration, error):
+    split_url = urlsplit(url)
+    kind = "elasticpath" if "elasticpath" in split_url.netloc else "yandex"
+    record_call(kind, f"{method.upper()} {split_url.path}", duration, error)
+
+
+def bind(function):
+    """
+    Переносит трассу текущего апдейта в функцию, которая выполнится
+    в другом потоке (предзагрузка страниц, фоновое обновление кэша).
+    Вызовы из неё попадают в трассу с пометкой background
+    """
+    trace = getattr(_local, "trace", None)
+    if trace is None:
+        return function
+
+    @functools.wraps(function)
+    def traced_function(*args, **kwargs):
+        _local.trace = trace
+        _local.background = True
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _local.trace = None
+            _local.background = False
+
+    return traced_function
+
+
+class TracedProxy:
+    """Обёртка над bot или Redis, записывающая длительность вызовов"""
+
+    def __init__(self, target, kind, prefix=""):
+        self._target = target
+        self._kind = kind
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if not callable(attribute):
+            return attribute
+        if name == "json":
+            return lambda: TracedProxy(attribute(), self._kind, "json.")
+
+        def traced_call(*args, **kwargs):
+            started_at = time.perf_counter()
+            error = None
+            try:
+                return attribute(*args, **kwargs)
+            except BaseException as err:
+                error = err
+                raise
+            finally:
+                record_call(
+                    self._kind,
+                    self._prefix + name,
+                    time.perf_counter() - started_at,
+                    error,
+                )
+
+        return traced_call
+
+
+class DisabledProfile:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def instrument(self, target, kind):
+        return target
+
+    def set_handler(self, state, handler):
+        pass
+
+
+_disabled_profile = DisabledProfile()
+
+
+class UpdateProfile(DisabledProfile):
+    def __init__(self, chat_id):
+        self.trace = {
+            "chat_id": chat_id,
+            "state": None,
+            "handler": None,
+            "started_at": time.time(),
+            "calls": [],
+        }
+        self.profile = None
+        if random.random() < _cprofile_sample_rate:
+            import cProfile
+
+            self.profile = cProfile.Profile()
+
+    def __enter__(self):
+        _local.trace = self.trace
+        self.started_at = time.perf_counter()
+        if self.profile:
+            self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.profile:
+            self.profile.disable()
+        duration = time.perf_counter() - self.started_at
+        _local.trace = None
+        if duration < _threshold:
+            return False
+
+        self.trace["duration"] = round(duration, 4)
+        if exc_value is not None:
+            self.trace["error"] = repr(exc_value)
+        if self.profile:
+            import pstats
+
+            stats_output = io.StringIO()
+            stats = pstats.Stats(self.profile, stream=stats_output)
+            stats.sort_stats("cumulative").print_stats(30)
+            self.trace["cprofile"] = stats_output.getvalue()
+        _traces.append(self.trace)
+        return False
+
+    def instrument(self, target, kind):
+        return TracedProxy(target, kind)
+
+    def set_handler(self, state, handler):
+        self.trace["state"] = state
+        self.trace["handler"] = handler
+
+
+def profile_update(chat_id):
+    if not _enabled:
+        return _disabled_profile
+    return UpdateProfile(chat_id)
+
+
+def get_traces():
+    return list(_traces)
+
+
+def dump_traces(path):
+    with open(path, "w") as my_file:
+        json.dump(get_traces(), my_file, ensure_ascii=False, indent=2)
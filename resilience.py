@@ -0,0 +1,207 @@
+"""
+Защита бота от сбоев Elastic Path.
+
+- ``circuit_breaker`` — после нескольких подряд сбоев эндпоинта запросы
+  к нему не отправляются (сразу CircuitOpenError), а через reset_timeout
+  секунд пропускается один пробный запрос;
+- ``stale_while_revalidate`` — для читающих эндпоинтов: устаревший ответ
+  из кэша отдаётся сразу, а свежий запрашивается в фоне.
+"""
+import functools
+import inspect
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import profiler
+from deadline import MIN_FAILURE_TIMEOUT, DeadlineExceeded
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30
+
+# Пороги для отдельных эндпоинтов: имя функции -> (сбоев, секунд)
+BREAKER_SETTINGS = {
+    "get_products": (3, 15),
+    "get_product_card": (3, 15),
+    "get_product_image": (3, 15),
+}
+
+logger = logging.getLogger(__name__)
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+_cache = {}
+_revalidating = set()
+_revalidating_lock = threading.Lock()
+_revalidate_executor = ThreadPoolExecutor(max_workers=4)
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, endpoint):
+        super().__init__(f"Elastic Path endpoint {endpoint} is unavailable")
+        self.endpoint = endpoint
+
+
+def is_upstream_failure(err):
+    if isinstance(err, DeadlineExceeded):
+        # Сбой, только если запрос отправлялся с достаточным таймаутом
+        # и не дождался ответа, а не получил остаток чужого бюджета
+        return (
+            err.timeout is not None
+            and err.timeout >= MIN_FAILURE_TIMEOUT
+        )
+    if isinstance(err, requests.exceptions.HTTPError):
+        status_code = err.response.status_code if err.response is not None else 500
+        return status_code >= 500 or status_code == 429
+    return isinstance(err, requests.exceptions.RequestException)
+
+
+class CircuitBreaker:
+    def __init__(self, endpoint, failure_threshold, reset_timeout):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        with self.lock:
+            return self.opened_at is not None and (
+                self.probing
+                or time.monotonic() - self.opened_at < self.reset_timeout
+            )
+
+    def call(self, function, *args, **kwargs):
+        with self.lock:
+            if self.opened_at is not None:
+                is_cooling_down = (
+                    time.monotonic() - self.opened_at < self.reset_timeout
+                )
+                if is_cooling_down or self.probing:
+                    raise CircuitOpenError(self.endpoint)
+                self.probing = True
+
+        try:
+            result = function(*args, **kwargs)
+        except Exception as err:
+            with self.lock:
+                self.probing = False
+                if is_upstream_failure(err):
+                    self.failures += 1
+                    if (
+                        self.opened_at is not None
+                        or self.failures >= self.failure_threshold
+                    ):
+                        self.opened_at = time.monotonic()
+                        logger.warning("Circuit opened for %s", self.endpoint)
+            raise
+
+        with self.lock:
+            if self.opened_at is not None:
+                logger.warning("Circuit closed for %s", self.endpoint)
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+        return result
+
+
+def get_breaker(endpoint):
+    with _breakers_lock:
+        breaker = _breakers.get(endpoint)
+        if breaker is None:
+            failure_threshold, reset_timeout = BREAKER_SETTINGS.get(
+                endpoint, (DEFAULT_FAILURE_THRESHOLD, DEFAULT_RESET_TIMEOUT)
+            )
+            breaker = _breakers[endpoint] = CircuitBreaker(
+                endpoint, failure_threshold, reset_timeout
+            )
+        return breaker
+
+
+def circuit_breaker(function):
+    breaker = get_breaker(function.__name__)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        return breaker.call(function, *args, **kwargs)
+
+    return wrapper
+
+
+def get_cache_key(function, signature, args, kwargs):
+    """Ключ кэша — имя функции и все аргументы, кроме токена"""
+    bound_arguments = signature.bind(*args, **kwargs)
+    bound_arguments.apply_defaults()
+    return (function.__name__,) + tuple(
+        value
+        for name, value in bound_arguments.arguments.items()
+        if name != "token"
+    )
+
+
+def revalidate(key, breaker, function, args, kwargs):
+    with _revalidating_lock:
+        if key in _revalidating:
+            return
+        _revalidating.add(key)
+
+    def refresh():
+        try:
+            _cache[key] = (
+                breaker.call(function, *args, **kwargs),
+                time.monotonic(),
+            )
+        except Exception as err:
+            logger.warning("Не удалось обновить %s: %s", key, err)
+        finally:
+            with _revalidating_lock:
+                _revalidating.discard(key)
+
+    _revalidate_executor.submit(profiler.bind(refresh))
+
+
+def stale_while_revalidate(ttl):
+    def decorator(function):
+        breaker = get_breaker(function.__name__)
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            key = get_cache_key(function, signature, args, kwargs)
+            cached = _cache.get(key)
+            if cached is None:
+                value = breaker.call(function, *args, **kwargs)
+                _cache[key] = (value, time.monotonic())
+                return value
+
+            value, fetched_at = cached
+            if time.monotonic() - fetched_at > ttl and not breaker.is_open:
+                revalidate(key, breaker, function, args, kwargs)
+            return value
+
+        def is_fresh(*args, **kwargs):
+            cached = _cache.get(get_cache_key(function, signature, args, kwargs))
+            return cached is not None and time.monotonic() - cached[1] <= ttl
+
+        def store(value, *args, **kwargs):
+            key = get_cache_key(function, signature, args, kwargs)
+            _cache[key] = (value, time.monotonic())
+
+        def store_stale(value, *args, **kwargs):
+            """Кладёт в кэш значение, которое будет обновлено при первом чтении"""
+            key = get_cache_key(function, signature, args, kwargs)
+            _cache[key] = (value, float("-inf"))
+
+        wrapper.is_fresh = is_fresh
+        wrapper.store = store
+        wrapper.store_stale = store_stale
+        return wrapper
+
+    return decorator
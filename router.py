@@ -0,0 +1,109 @@
+"""
+Маршрутизатор состояний бота.
+
+Состояния, их обработчики, нужные обработчикам ресурсы и допустимые
+переходы регистрируются один раз при старте. На каждый апдейт остаётся
+один поиск в таблице; ресурсы (токен, Redis и т.д.) получаются лениво
+и только те, что объявил обработчик.
+
+Переход в END завершает диалог: сохранённое состояние чата удаляется,
+и следующее сообщение пользователя начинается с START. Если обработчик
+вернул необъявленное состояние (в том числе None), состояние чата
+не меняется.
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+Route = namedtuple("Route", ["handler", "requires", "transitions"])
+
+# Обработчик, завершающий диалог, возвращает END явно
+END = "END"
+
+
+class Resources:
+    """Ресурсы апдейта: фабрика вызывается при первом обращении"""
+
+    def __init__(self, factories):
+        self._factories = factories
+        self._values = {}
+
+    def get(self, name):
+        if name not in self._values:
+            self._values[name] = self._factories[name]()
+        return self._values[name]
+
+
+class Router:
+    def __init__(self):
+        self.routes = {}
+        self.table = None
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+    def register(self, state, handler, requires=(), transitions=()):
+        if self.table is not None:
+            raise RuntimeError("Router is already compiled")
+        self.routes[state] = Route(
+            handler, tuple(requires), frozenset(transitions)
+        )
+
+    def compile(self):
+        if END in self.routes:
+            raise ValueError(f"{END} is reserved for finished conversations")
+        for state, route in self.routes.items():
+            unknown_states = route.transitions - set(self.routes) - {END}
+            if unknown_states:
+                raise ValueError(
+                    f"{state}: unknown transitions {sorted(unknown_states)}"
+                )
+        self.table = dict(self.routes)
+        self.stats = {state: [0, 0.0] for state in self.table}
+
+    def get_handler(self, state):
+        return self.table[state].handler
+
+    def save_state(self, db, chat_id, next_state):
+        """Сохраняет состояние чата, на END удаляет его, на None не меняет"""
+        if next_state is None:
+            return
+        if next_state == END:
+            db.delete(chat_id)
+        else:
+            db.set(chat_id, next_state)
+
+    def dispatch(self, state, bot, update, resources):
+        """Следующее состояние или None, если переход не объявлен"""
+        route = self.table[state]
+        kwargs = {name: resources.get(name) for name in route.requires}
+
+        started_at = time.perf_counter()
+        try:
+            next_state = route.handler(bot, update, **kwargs)
+        finally:
+            duration = time.perf_counter() - started_at
+            with self.stats_lock:
+                state_stats = self.stats[state]
+                state_stats[0] += 1
+                state_stats[1] += duration
+
+        if route.transitions and next_state not in route.transitions:
+            logger.warning(
+                "Unexpected transition %s -> %s", state, next_state
+            )
+            return None
+        return next_state
+
+    def get_stats(self):
+        """Число вызовов и среднее время обработчика по состояниям, мс"""
+        with self.stats_lock:
+            return {
+                state: {
+                    "count": count,
+                    "average_ms": round(total / count * 1000, 1) if count else 0,
+                }
+                for state, (count, total) in self.stats.items()
+            }
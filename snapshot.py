@@ -0,0 +1,76 @@
+"""
+Снимок каталога для быстрого старта бота.
+
+В файл сохраняются список товаров, карточки товаров со ссылками на фото
+и список пиццерий. При старте снимок загружается в кэш Elastic Path как
+устаревший: первые пользователи сразу получают ответ из снимка, а свежие
+данные подтягиваются в фоне.
+"""
+import logging
+import os
+import pickle
+import time
+
+from elasticpath import (
+    get_all_pizzerias,
+    get_product_card,
+    get_product_cards,
+    get_products,
+)
+
+SNAPSHOT_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+
+def write_snapshot(path, products, product_cards, pizzerias):
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "created_at": time.time(),
+        "products": products,
+        "product_cards": product_cards,
+        "pizzerias": pizzerias,
+    }
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as snapshot_file:
+        pickle.dump(snapshot, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary_path, path)
+
+
+def load_snapshot(path):
+    """Загружает снимок в кэш. Возвращает False, если снимка нет"""
+    started_at = time.perf_counter()
+    try:
+        with open(path, "rb") as snapshot_file:
+            snapshot = pickle.load(snapshot_file)
+    except FileNotFoundError:
+        return False
+    except Exception as err:
+        logger.warning("Не удалось прочитать снимок каталога %s: %s", path, err)
+        return False
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        return False
+
+    get_products.store_stale(snapshot["products"], None)
+    get_all_pizzerias.store_stale(snapshot["pizzerias"], None)
+    for product_id, product_card in snapshot["product_cards"].items():
+        get_product_card.store_stale(product_card, product_id, None)
+    logger.info(
+        "Снимок каталога от %s загружен за %.1f мс",
+        time.ctime(snapshot["created_at"]),
+        (time.perf_counter() - started_at) * 1000,
+    )
+    return True
+
+
+def refresh_snapshot(path, token):
+    """Запрашивает каталог из Elastic Path, обновляет кэш и снимок"""
+    products = get_products.__wrapped__(token)
+    product_cards = get_product_cards(token)
+    pizzerias = get_all_pizzerias.__wrapped__(token)
+
+    get_products.store(products, token)
+    get_all_pizzerias.store(pizzerias, token)
+    for product_id, product_card in product_cards.items():
+        get_product_card.store(product_card, product_id, token)
+    write_snapshot(path, products, product_cards, pizzerias)
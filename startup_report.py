@@ -0,0 +1,91 @@
+"""
+Отчёт о времени запуска бота.
+
+Импортирует tg_bot в отдельном процессе с ``python -X importtime`` и
+выводит общее время импорта, самые медленные модули и то, какие
+необязательные подсистемы (валидация email, geopy, админские функции
+каталога) не загрузились при старте. С --snapshot дополнительно
+измеряет загрузку снимка каталога.
+
+Пример запуска:
+
+    python3 startup_report.py --top 15 --snapshot catalog_snapshot.pickle
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+LAZY_MODULES = ("validate_email", "geopy", "slugify", "cProfile")
+
+PROBE = """
+import json, sys, time
+started_at = time.perf_counter()
+import tg_bot
+import_time = time.perf_counter() - started_at
+snapshot_time = None
+if len(sys.argv) > 1:
+    started_at = time.perf_counter()
+    tg_bot.snapshot.load_snapshot(sys.argv[1])
+    snapshot_time = time.perf_counter() - started_at
+print(json.dumps({
+    "import_time": import_time,
+    "snapshot_time": snapshot_time,
+    "loaded": [name for name in %r if name in sys.modules],
+}))
+""" % (LAZY_MODULES,)
+
+
+def parse_importtime(stderr):
+    """Строки вида 'import time: self | cumulative | module', мкс"""
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        timings = line[len("import time:"):]
+        self_time, cumulative_time, module = timings.split("|")
+        modules.append(
+            (module.strip(), int(self_time), int(cumulative_time))
+        )
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Время запуска tg_bot")
+    parser.add_argument("--top", type=int, default=20,
+                        help="сколько самых медленных модулей показать")
+    parser.add_argument("--snapshot",
+                        help="путь к снимку каталога для замера загрузки")
+    args = parser.parse_args()
+
+    command = [sys.executable, "-X", "importtime", "-c", PROBE]
+    if args.snapshot:
+        command.append(args.snapshot)
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode:
+        sys.exit(result.stderr)
+    probe = json.loads(result.stdout.strip().splitlines()[-1])
+
+    print(f"Импорт tg_bot: {probe['import_time'] * 1000:.1f} мс")
+    if probe["snapshot_time"] is not None:
+        snapshot_time = probe["snapshot_time"] * 1000
+        print(f"Загрузка снимка каталога: {snapshot_time:.1f} мс")
+    lazy_loaded = set(probe["loaded"])
+    for module in LAZY_MODULES:
+        status = "загружен при старте" if module in lazy_loaded else "отложен"
+        print(f"  {module}: {status}")
+
+    print()
+    print(f"{'module':<40}{'self ms':>10}{'cumulative ms':>15}")
+    slowest_modules = sorted(
+        parse_importtime(result.stderr), key=lambda module: -module[2]
+    )[:args.top]
+    for name, self_time, cumulative_time in slowest_modules:
+        print(
+            f"{name:<40}{self_time / 1000:>10.1f}"
+            f"{cumulative_time / 1000:>15.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
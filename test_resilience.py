@@ -0,0 +1,202 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+import requests
+
+import resilience
+from deadline import DeadlineExceeded
+from resilience import CircuitBreaker, CircuitOpenError
+
+
+def upstream_error():
+    return requests.exceptions.ConnectionError("connection refused")
+
+
+def http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.exceptions.HTTPError(response=response)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FailingCall:
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return "ok"
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch("resilience.time.monotonic", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(
+            "test", failure_threshold=3, reset_timeout=30
+        )
+
+    def fail(self, times, error=None):
+        function = FailingCall(error or upstream_error())
+        for _ in range(times):
+            with self.assertRaises(Exception):
+                self.breaker.call(function)
+        return function
+
+    def test_opens_after_threshold(self):
+        self.fail(2)
+        self.assertFalse(self.breaker.is_open)
+        self.fail(1)
+        self.assertTrue(self.breaker.is_open)
+
+        function = FailingCall()
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.call(function)
+        self.assertEqual(function.calls, 0)
+
+    def test_success_resets_failures(self):
+        self.fail(2)
+        self.assertEqual(self.breaker.call(FailingCall()), "ok")
+        self.fail(2)
+        self.assertFalse(self.breaker.is_open)
+
+    def test_client_errors_are_not_counted(self):
+        self.fail(5, http_error(404))
+        self.assertEqual(self.breaker.failures, 0)
+        self.fail(3, http_error(503))
+        self.assertTrue(self.breaker.is_open)
+
+    def test_half_open_probe_success_closes(self):
+        self.fail(3)
+        self.clock.now += 31
+        self.assertFalse(self.breaker.is_open)
+        self.assertEqual(self.breaker.call(FailingCall()), "ok")
+        self.assertFalse(self.breaker.is_open)
+        self.assertEqual(self.breaker.failures, 0)
+
+    def test_half_open_probe_failure_reopens(self):
+        self.fail(3)
+        self.clock.now += 31
+        self.fail(1)
+        self.assertTrue(self.breaker.is_open)
+        self.clock.now += 29
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.call(FailingCall())
+
+    def test_only_one_probe_at_a_time(self):
+        self.fail(3)
+        self.clock.now += 31
+        probe_started = threading.Event()
+        release_probe = threading.Event()
+
+        def slow_probe():
+            probe_started.set()
+            release_probe.wait(5)
+            return "ok"
+
+        probe = threading.Thread(target=self.breaker.call, args=(slow_probe,))
+        probe.start()
+        probe_started.wait(5)
+        self.assertTrue(self.breaker.is_open)
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.call(FailingCall())
+        release_probe.set()
+        probe.join(5)
+        self.assertFalse(self.breaker.is_open)
+
+
+class IsUpstreamFailureTest(unittest.TestCase):
+    def test_http_statuses(self):
+        self.assertTrue(resilience.is_upstream_failure(http_error(500)))
+        self.assertTrue(resilience.is_upstream_failure(http_error(429)))
+        self.assertFalse(resilience.is_upstream_failure(http_error(401)))
+
+    def test_deadline_exceeded_before_request(self):
+        self.assertFalse(
+            resilience.is_upstream_failure(DeadlineExceeded("GET x"))
+        )
+
+    def test_deadline_exceeded_counts_only_long_timeouts(self):
+        self.assertFalse(
+            resilience.is_upstream_failure(
+                DeadlineExceeded("GET x", timeout=0.3)
+            )
+        )
+        self.assertTrue(
+            resilience.is_upstream_failure(DeadlineExceeded("GET x", timeout=8))
+        )
+
+
+def wait_for_revalidation():
+    for _ in range(500):
+        with resilience._revalidating_lock:
+            if not resilience._revalidating:
+                return
+        time.sleep(0.01)
+    raise AssertionError("revalidation did not finish")
+
+
+class StaleWhileRevalidateTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch("resilience.time.monotonic", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(resilience._cache.clear)
+        resilience._cache.clear()
+
+        self.calls = []
+
+        @resilience.stale_while_revalidate(60)
+        def get_value(key, token):
+            self.calls.append((key, token))
+            return f"{key}:{len(self.calls)}"
+
+        self.get_value = get_value
+
+    def test_fresh_value_is_cached_without_token(self):
+        self.assertEqual(self.get_value("a", "token-1"), "a:1")
+        self.assertEqual(self.get_value("a", "token-2"), "a:1")
+        self.assertEqual(len(self.calls), 1)
+        self.assertTrue(self.get_value.is_fresh("a", None))
+
+    def test_stale_value_is_returned_and_revalidated(self):
+        self.get_value("a", "token")
+        self.clock.now += 61
+        self.assertFalse(self.get_value.is_fresh("a", None))
+
+        self.assertEqual(self.get_value("a", "token"), "a:1")
+        wait_for_revalidation()
+        self.assertEqual(self.get_value("a", "token"), "a:2")
+
+    def test_store_stale_serves_value_then_refreshes(self):
+        self.get_value.store_stale("from-snapshot", "a", None)
+        self.assertFalse(self.get_value.is_fresh("a", None))
+
+        self.assertEqual(self.get_value("a", "token"), "from-snapshot")
+        wait_for_revalidation()
+        self.assertEqual(self.get_value("a", "token"), "a:1")
+
+    def test_store_marks_value_fresh(self):
+        self.get_value.store("stored", "a", None)
+        self.assertTrue(self.get_value.is_fresh("a", None))
+        self.assertEqual(self.get_value("a", "token"), "stored")
+        self.assertEqual(self.calls, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,10 +1,14 @@
+import contextlib
 import functools
+import json
+import threading
+from collections import Counter
 from textwrap import dedent
 
 from dotenv import load_dotenv
 import os
+import signal
 
-import redis
 from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
@@ -13,44 +17,161 @@ from telegram import (
     LabeledPrice,
 )
 
+from telegram.error import BadRequest
 from telegram.ext import Filters, Updater, PreCheckoutQueryHandler
 from telegram.ext import CallbackQueryHandler, CommandHandler, MessageHandler
-from validate_email import validate_email
 
 from elasticpath import (
     get_token,
+    is_token_rejected,
     get_products,
-    get_product_by_id,
+    get_product_card,
     get_cart,
-    get_product_image,
     add_product_to_cart,
     get_carts_sum,
     delete_product_from_cart,
     create_customer,
     get_all_pizzerias,
+    get_pizzeria,
     add_customer_address,
     get_entries_by_id,
     delete_all_cart_products,
+    prefetch_products,
 )
 
+import courier_dispatch
+from database import get_database_connection, get_pool_stats
+from deadline import DeadlineExceeded, get_exceeded_counts, start_deadline
 from geocoder import get_coordinates, get_distance
+from log_config import setup_logging, update_context
+from order_events import append_event
+import profiler
+from router import END, Resources, Router
+import snapshot
+from resilience import CircuitOpenError, is_upstream_failure
+import transport
 
 import logging
 
-_database = None
+CART_TAPS_WINDOW = 1.5
+UPDATE_DEADLINE = 8
+# Сколько хранить в Redis данные заказа, ожидающего оплаты
+ORDER_DATA_TTL = 24 * 3600
 
+_pending_cart_items = {}
+_pending_cart_lock = threading.Lock()
+_cart_flush_locks = {}
 
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.DEBUG,
-)
 
 logger = logging.getLogger(__name__)
 
 
 def error(bot, update, error):
     """Log Errors caused by Updates."""
-    logger.warning('Update "%s" caused error "%s"', update, error)
+    update_id = update.update_id if update else None
+    logger.warning('Update "%s" caused error "%s"', update_id, error)
+
+
+def queue_product_to_cart(chat_id, token_source, product_id, quantity=1):
+    """
+    Копит нажатия «Добавить в корзину» и через CART_TAPS_WINDOW секунд
+    отправляет их одним запросом на каждый товар с суммарным количеством.
+    token_source(refresh=False) возвращает токен Elastic Path
+    """
+    with _pending_cart_lock:
+        pending = _pending_cart_items.get(chat_id)
+        if pending is None:
+            pending = _pending_cart_items[chat_id] = (Counter(), token_source)
+            timer = threading.Timer(
+                CART_TAPS_WINDOW, flush_cart_taps, args=(chat_id,)
+            )
+            timer.daemon = True
+            timer.start()
+        pending_items, _ = pending
+        pending_items[product_id] += quantity
+
+
+@contextlib.contextmanager
+def hold_cart_flush_lock(chat_id):
+    """Блокировка отправки нажатий чата; удаляется, когда никто её не ждёт"""
+    with _pending_cart_lock:
+        lock, holders = _cart_flush_locks.get(chat_id, (threading.Lock(), 0))
+        _cart_flush_locks[chat_id] = (lock, holders + 1)
+    try:
+        with lock:
+            yield
+    finally:
+        with _pending_cart_lock:
+            lock, holders = _cart_flush_locks[chat_id]
+            if holders == 1:
+                del _cart_flush_locks[chat_id]
+            else:
+                _cart_flush_locks[chat_id] = (lock, holders - 1)
+
+
+def is_retryable(err):
+    return (
+        isinstance(err, (CircuitOpenError, DeadlineExceeded))
+        or is_upstream_failure(err)
+    )
+
+
+def flush_cart_taps(chat_id):
+    """
+    Отправляет накопленные нажатия. Пока идёт отправка, другие вызовы
+    для того же чата ждут её окончания, поэтому корзина, показанная
+    после flush_cart_taps, уже содержит все нажатия. Если токен устарел,
+    он обновляется и запрос повторяется. Нажатия, которые не удалось
+    отправить из-за сбоя Elastic Path или дедлайна, ставятся в очередь
+    снова. Возвращает False, если какие-то нажатия не попали в корзину
+    """
+    is_flushed = True
+    with hold_cart_flush_lock(chat_id):
+        with _pending_cart_lock:
+            pending = _pending_cart_items.pop(chat_id, None)
+        if not pending:
+            return is_flushed
+        pending_items, token_source = pending
+        token = None
+        for product_id, quantity in pending_items.items():
+            try:
+                if token is None:
+                    token = token_source()
+                try:
+                    add_product_to_cart(chat_id, token, product_id, quantity)
+                except Exception as err:
+                    if not is_token_rejected(err):
+                        raise
+                    token = token_source(refresh=True)
+                    add_product_to_cart(chat_id, token, product_id, quantity)
+            except Exception as err:
+                is_flushed = False
+                if not is_retryable(err):
+                    logger.error(
+                        "Не удалось добавить %s x%s в корзину %s: %s",
+                        product_id,
+                        quantity,
+                        chat_id,
+                        err,
+                    )
+                    continue
+                logger.warning(
+                    "Повторим добавление %s x%s в корзину %s: %s",
+                    product_id,
+                    quantity,
+                    chat_id,
+                    err,
+                )
+                queue_product_to_cart(
+                    chat_id, token_source, product_id, quantity
+                )
+    return is_flushed
+
+
+def log_stats(bot, job):
+    logger.info("Redis pool: %s", get_pool_stats())
+    logger.info("States: %s", router.get_stats())
+    logger.info("Deadline exceeded: %s", get_exceeded_counts())
 
 
 def create_products_buttons(token):
@@ -58,6 +179,7 @@ def create_products_buttons(token):
     Функция для создания кнопок меню с товарами
     """
     products = get_products(token)["data"]
+    prefetch_products(token, [product["id"] for product in products])
     keyboard = [
         [
             InlineKeyboardButton(
@@ -93,7 +215,7 @@ def handle_menu(bot, update, token):
         handle_cart(bot, update, token)
         return "HANDLE_CART"
     product_id = update.callback_query.data
-    product = get_product_by_id(product_id, token)
+    product, image_url = get_product_card(product_id, token)
 
     product_name = product["attributes"]["name"]
     product_price = product["meta"]["display_price"]["without_tax"][
@@ -101,9 +223,6 @@ def handle_menu(bot, update, token):
     ]
     product_description = product["attributes"]["description"]
 
-    image_id = product["relationships"]["main_image"]["data"]["id"]
-    image_url = get_product_image(token, image_id)["data"]["link"]["href"]
-
     message = f"{product_name}\n\n{product_price}\n\n{product_description}"
     keyboard = [
         [
@@ -116,16 +235,23 @@ def handle_menu(bot, update, token):
         [InlineKeyboardButton("Перейти в корзину", callback_data="cart")],
     ]
     reply_markup = InlineKeyboardMarkup(keyboard, n_cols=3)
-    bot.send_photo(
-        chat_id=query.message.chat_id,
-        photo=image_url,
-        caption=message,
-        reply_markup=reply_markup,
-    )
+    if image_url is None:
+        bot.send_message(
+            chat_id=query.message.chat_id,
+            text=message,
+            reply_markup=reply_markup,
+        )
+    else:
+        bot.send_photo(
+            chat_id=query.message.chat_id,
+            photo=image_url,
+            caption=message,
+            reply_markup=reply_markup,
+        )
     return "HANDLE_DESCRIPTION"
 
 
-def handle_description(bot, update, token):
+def handle_description(bot, update, token, token_source):
     query = update.callback_query
     chat_id = query["message"]["chat"]["id"]
     if query.data == "start":
@@ -138,7 +264,7 @@ def handle_description(bot, update, token):
         split_query = query.data.split(", ")
         if split_query[0] == "add_to_cart":
             product_id = split_query[1]
-            add_product_to_cart(chat_id, token, product_id)
+            queue_product_to_cart(chat_id, token_source, product_id)
             bot.answer_callback_query(
                 callback_query_id=query.id,
                 text="Товар добавлен в корзину",
@@ -147,48 +273,96 @@ def handle_description(bot, update, token):
         return "HANDLE_DESCRIPTION"
 
 
+@functools.lru_cache(maxsize=1024)
+def render_cart_line(product_id, unit_price, name, description, quantity):
+    return dedent(
+        f"""\
+        {name}
+        {description}
+
+        {quantity} шт.
+        Цена за штуку: {unit_price}
+        ______________________________
+
+        """
+    )
+
+
+def render_cart(products_cart, carts_sum):
+    message = "".join(
+        render_cart_line(
+            product["product_id"],
+            product["meta"]["display_price"]["without_tax"]["unit"]["formatted"],
+            product["name"],
+            product["description"],
+            product["quantity"],
+        )
+        for product in products_cart
+    )
+    return f"{message}Итого к оплате: {carts_sum}\n"
+
+
+def show_cart(bot, query, token, chat_id):
+    """
+    Показывает корзину. Если нажата кнопка в текстовом сообщении
+    (меню или сама корзина), оно редактируется, а не отправляется новое
+    """
+    products_cart = get_cart(token, chat_id)
+    carts_sum, payment_sum = get_carts_sum(token, chat_id)
+
+    message = render_cart(products_cart, carts_sum)
+    keyboard = [
+        [
+            InlineKeyboardButton(
+                f'Удалить {product["name"]}',
+                callback_data=f'delete,{product["id"]}',
+            )
+        ]
+        for product in products_cart
+    ]
+    if products_cart:
+        keyboard.append(
+            [InlineKeyboardButton("Оформить заказ", callback_data="order")]
+        )
+    keyboard.append([InlineKeyboardButton("Меню", callback_data="start")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    if not query.message.text:
+        bot.send_message(
+            chat_id=chat_id, text=message, reply_markup=reply_markup
+        )
+        return
+    try:
+        if query.message.text.strip() == message.strip():
+            bot.edit_message_reply_markup(
+                chat_id=chat_id,
+                message_id=query.message.message_id,
+                reply_markup=reply_markup,
+            )
+        else:
+            bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=query.message.message_id,
+                text=message,
+                reply_markup=reply_markup,
+            )
+    except BadRequest as err:
+        if "not modified" not in str(err):
+            raise
+
+
 def handle_cart(bot, update, token):
     query = update.callback_query
     chat_id = query["message"]["chat"]["id"]
-    if query.data == "cart":
-        products_cart = get_cart(token, chat_id)
-        carts_sum, payment_sum = get_carts_sum(token, chat_id)
-
-        message = ""
-        for product in products_cart:
-            cart_description = f"""\
-                                   {product["name"]}
-                                   {product["description"]} 
-
-                                   {product["quantity"]} шт.  
-                                   Цена за штуку: {product["meta"]["display_price"]["without_tax"]["unit"]["formatted"]}
-                                   ______________________________
-                                    
-                                    """
-            message += dedent(cart_description)
-        sum_message = f"""\
-                            Итого к оплате: {carts_sum}
-                                
-                        """
-        message += dedent(sum_message)
-        keyboard = [
-            [
-                InlineKeyboardButton(
-                    f'Удалить {product["name"]}',
-                    callback_data=f'delete,{product["id"]}',
-                )
-            ]
-            for product in products_cart
-        ]
-        if products_cart:
-            keyboard.append(
-                [InlineKeyboardButton("Оформить заказ", callback_data="order")]
-            )
-        keyboard.append([InlineKeyboardButton("Меню", callback_data="start")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    is_flushed = flush_cart_taps(chat_id)
+    if not is_flushed:
         bot.send_message(
-            chat_id=chat_id, text=message, reply_markup=reply_markup
+            chat_id=chat_id,
+            text="Часть товаров ещё не добавлена в корзину. "
+            "Откройте корзину ещё раз через несколько секунд",
         )
+    if query.data == "cart":
+        show_cart(bot, query, token, chat_id)
         return "HANDLE_DESCRIPTION"
     elif query.data == "start":
         start(bot, update, token)
@@ -201,53 +375,25 @@ def handle_cart(bot, update, token):
             text="Товар удален из корзины",
             show_alert=False,
         )
-        products_cart = get_cart(token, chat_id)
-        carts_sum, payment_sum = get_carts_sum(token, chat_id)
-        message = ""
-        for product in products_cart:
-            cart_description = f"""\
-                                   {product["name"]}
-                                   {product["description"]} 
-
-                                   {product["quantity"]} шт.  
-                                   Цена за штуку: {product["meta"]["display_price"]["without_tax"]["unit"]["formatted"]}
-                                   ______________________________
-                                    
-                                    """
-            message += dedent(cart_description)
-        sum_message = f"""\
-                            Итого к оплате: {carts_sum}
-                                
-                        """
-        message += dedent(sum_message)
-        keyboard = [
-            [
-                InlineKeyboardButton(
-                    f'Удалить {product["name"]}',
-                    callback_data=f'delete,{product["id"]}',
-                )
-            ]
-            for product in products_cart
-        ]
-        if products_cart:
-            keyboard.append(
-                [InlineKeyboardButton("Оплата", callback_data="pay")]
-            )
-        keyboard.append([InlineKeyboardButton("Меню", callback_data="start")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        bot.send_message(
-            chat_id=chat_id, text=message, reply_markup=reply_markup
-        )
-        return "HANDLE_DESCRIPTION"
+        show_cart(bot, query, token, chat_id)
+        return "HANDLE_CART"
     elif query.data == "order":
         bot.send_message(chat_id=chat_id, text="Введите Ваш email:")
         return "WAITING_EMAIL"
 
 
+def is_valid_email(email):
+    # validate_email при импорте загружает чёрный список доменов,
+    # поэтому он импортируется при первой проверке адреса
+    from validate_email import validate_email
+
+    return validate_email(email=email)
+
+
 def waiting_email(bot, update, token):
     email = update.message.text
     chat_id = update.message.chat_id
-    is_valid = validate_email(email=email)
+    is_valid = is_valid_email(email)
     if is_valid:
         create_customer(token, email, chat_id)
         message_keyboard = [
@@ -292,19 +438,23 @@ def handle_waiting(bot, update, api_key, token, db):
         .get("id")
     )
 
-    distances = {}
-    all_pizzerias = get_all_pizzerias(token)
-    for pizzeria in all_pizzerias["data"]:
-        pizzeria_coords = (pizzeria["latitude"], pizzeria["longitude"])
-        distance_to_pizzeria = get_distance(coordinates, pizzeria_coords)
-        distances[distance_to_pizzeria] = (pizzeria["address"], pizzeria["id"])
-    min_distance = min(distances.items(), key=lambda x: x[0])
+    distances = (
+        (
+            get_distance(
+                coordinates, (pizzeria["latitude"], pizzeria["longitude"])
+            ),
+            (pizzeria["address"], pizzeria["id"]),
+        )
+        for pizzeria in get_all_pizzerias(token)["data"]
+    )
+    min_distance = min(distances, key=lambda x: x[0])
 
     distance_to_pizzeria = min_distance[0]
     pizzeria_address = min_distance[1][0]
     pizzeria_id = min_distance[1][1]
 
     db.set(f"{chat_id}_order", f"{customer_address_id}${pizzeria_id}")
+    db.set(f"{chat_id}_distance", distance_to_pizzeria, ex=ORDER_DATA_TTL)
 
     keyboard = [
         [InlineKeyboardButton("Доставка", callback_data="delivery")],
@@ -347,8 +497,13 @@ def handle_delivery(bot, update, token, db):
     entry_ids = db.get(f"{customer_chat_id}_order").decode("utf-8")
     customer_address_id, pizzeria_id = entry_ids.split("$")
 
-    pizzeria = get_entries_by_id(
-        token, entry_id=pizzeria_id, flow_slug="pizzeri-aaddresses"
+    pizzeria = get_pizzeria(token, pizzeria_id)
+    append_event(
+        db,
+        "delivery_chosen",
+        customer_chat_id,
+        order_type=order_type,
+        pizzeria_id=pizzeria_id,
     )
 
     if order_type == "delivery":
@@ -365,8 +520,9 @@ def handle_delivery(bot, update, token, db):
         db.json().set(f"{customer_chat_id}_menu", "$", {"price": payment_sum})
         return "WAITING_PAYMENT"
     elif order_type == "pickup":
-        message = f"Вы можете забрать по адресу: {pizzeria.get('data').get('address')}. До свидания!"
+        message = f"Вы можете забрать по адресу: {pizzeria.get('address')}. До свидания!"
         bot.send_message(chat_id=customer_chat_id, text=message)
+        return END
 
 
 def pay_for_pizza(bot, update, provider_token, db, chat_id):
@@ -403,9 +559,22 @@ def precheckout_callback(bot, update):
         bot.answer_pre_checkout_query(pre_checkout_query_id=query.id, ok=True)
 
 
-def successful_payment_callback(bot, update, job_queue):
+def successful_payment_callback(bot, update, job_queue, host, port, password):
+    chat_id = update.message.chat_id
     update.message.reply_text("Thank you for your payment!")
-    job_queue.run_once(send_delivery_notification, 3600, context=update.message.chat_id)
+
+    db = get_database_connection(host, port, password)
+    order = db.get(f"{chat_id}_order_summary")
+    if order:
+        order = json.loads(order)
+        courier = order.pop("courier")
+        courier_dispatch.add_order(
+            bot, db, courier["pizzeria"], courier["order"]
+        )
+        order["sum"] = update.message.successful_payment.total_amount
+        append_event(db, "order_completed", chat_id, **order)
+        db.delete(f"{chat_id}_order_summary")
+    job_queue.run_once(send_delivery_notification, 3600, context=chat_id)
 
 
 def send_delivery_notification(bot, job):
@@ -422,27 +591,34 @@ def handle_payment(bot, update, provider_token, db, token):
     query = update.callback_query["data"]
     chat_id = update.callback_query["message"]["chat"]["id"]
     if query == 'payment':
+        if not flush_cart_taps(chat_id):
+            bot.send_message(
+                chat_id=chat_id,
+                text="Не удалось обновить корзину, попробуйте оплатить ещё раз",
+            )
+            return "WAITING_PAYMENT"
         pay_for_pizza(bot, update, provider_token, db, chat_id)
-        send_message_to_courier(bot, update, db, chat_id, token)
+        order = prepare_order(db, chat_id, token)
+        # Курьер и выручка — только после successful_payment
+        db.set(
+            f"{chat_id}_order_summary", json.dumps(order), ex=ORDER_DATA_TTL
+        )
         delete_all_cart_products(token, chat_id)
+        return END
 
 
-def send_message_to_courier(bot, update, db, chat_id, token):
+def prepare_order(db, chat_id, token):
+    """
+    Сводка заказа для журнала событий и сообщение для курьера.
+    Курьеру заказ уходит только после successful_payment
+    """
     order = get_cart(token, chat_id)
     carts_sum, payment_sum = get_carts_sum(token, chat_id)
 
     entry_ids = db.get(f"{chat_id}_order").decode("utf-8")
     customer_address_id, pizzeria_id = entry_ids.split("$")
 
-    courier_telegram_id = (
-        (
-            get_entries_by_id(
-                token, entry_id=pizzeria_id, flow_slug="pizzeri-aaddresses"
-            )
-        )
-        .get("data")
-        .get("courier-telegram-id")
-    )
+    pizzeria = get_pizzeria(token, pizzeria_id)
     customer_address = get_entries_by_id(
         token, entry_id=customer_address_id, flow_slug="customer-address"
     )
@@ -450,33 +626,88 @@ def send_message_to_courier(bot, update, db, chat_id, token):
     longitude = customer_address.get("data").get("longitude")
     latitude = customer_address.get("data").get("latitude")
 
-    message = ""
-    for product in order:
-        cart_description = f"""\
-                               {product["name"]}
-                               {product["description"]}
-
-                               {product["quantity"]} шт.
-                               Цена за штуку: {product["meta"]["display_price"]["without_tax"]["unit"]["formatted"]}
-                               ______________________________
-
-                                """
-        message += dedent(cart_description)
-    sum_message = f"""\
-                        Итого к оплате: {carts_sum}
-
-                    """
-    message += dedent(sum_message)
+    message = render_cart(order, carts_sum)
+
+    courier = {
+        "pizzeria": {
+            "id": pizzeria_id,
+            "courier_id": pizzeria.get("courier-telegram-id"),
+            "latitude": pizzeria.get("latitude"),
+            "longitude": pizzeria.get("longitude"),
+        },
+        "order": {
+            "text": message,
+            "latitude": latitude,
+            "longitude": longitude,
+        },
+    }
 
-    bot.send_message(chat_id=courier_telegram_id, text=message)
-    bot.send_location(chat_id=courier_telegram_id, latitude=latitude, longitude=longitude)
+    distance = db.get(f"{chat_id}_distance")
+    return {
+        "items": [
+            {
+                "product_id": product["product_id"],
+                "name": product["name"],
+                "quantity": product["quantity"],
+            }
+            for product in order
+        ],
+        "sum": payment_sum,
+        "pizzeria_id": pizzeria_id,
+        "distance": float(distance) if distance else None,
+        "courier": courier,
+    }
 
 
-def get_database_connection(host, port, password):
-    global _database
-    if _database is None:
-        _database = redis.Redis(host=host, port=port, password=password)
-    return _database
+router = Router()
+router.register(
+    "START", start, requires=("token",), transitions=("HANDLE_MENU",)
+)
+router.register(
+    "HANDLE_MENU",
+    handle_menu,
+    requires=("token",),
+    transitions=("HANDLE_CART", "HANDLE_DESCRIPTION"),
+)
+router.register(
+    "HANDLE_DESCRIPTION",
+    handle_description,
+    requires=("token", "token_source"),
+    transitions=("HANDLE_MENU", "HANDLE_CART", "HANDLE_DESCRIPTION"),
+)
+router.register(
+    "HANDLE_CART",
+    handle_cart,
+    requires=("token",),
+    transitions=(
+        "HANDLE_DESCRIPTION", "HANDLE_CART", "HANDLE_MENU", "WAITING_EMAIL"
+    ),
+)
+router.register(
+    "WAITING_EMAIL",
+    waiting_email,
+    requires=("token",),
+    transitions=("WAITING_LOCATION", "WAITING_EMAIL"),
+)
+router.register(
+    "WAITING_LOCATION",
+    handle_waiting,
+    requires=("api_key", "token", "db"),
+    transitions=("WAITING_LOCATION", "WAITING_PIZZA"),
+)
+router.register(
+    "WAITING_PIZZA",
+    handle_delivery,
+    requires=("token", "db"),
+    transitions=("WAITING_PAYMENT", END),
+)
+router.register(
+    "WAITING_PAYMENT",
+    handle_payment,
+    requires=("provider_token", "db", "token"),
+    transitions=("WAITING_PAYMENT", END),
+)
+router.compile()
 
 
 def handle_users_reply(
@@ -490,54 +721,76 @@ def handle_users_reply(
     provider_token,
     yandex_api_key,
 ):
-    db = get_database_connection(host, port, password)
     if update.message:
         user_reply = update.message.text
         chat_id = update.message.chat_id
     elif update.callback_query:
         user_reply = update.callback_query.data
         chat_id = update.callback_query.message.chat_id
-    elif update.message.location:
-        user_reply = update.message.location
-        chat_id = update.message.chat_id
-    elif update.pre_checkout_query:
-        user_reply = update.pre_checkout_query
-        chat_id = update.message.chat_id
     else:
         return
-    if user_reply == "/start":
-        user_state = "START"
-    else:
-        user_state = db.get(chat_id).decode("utf-8")
-    token = get_token(client_id, client_secret, db)
-    states_functions = {
-        "START": functools.partial(start, token=token),
-        "HANDLE_MENU": functools.partial(handle_menu, token=token),
-        "HANDLE_DESCRIPTION": functools.partial(
-            handle_description, token=token
-        ),
-        "HANDLE_CART": functools.partial(handle_cart, token=token),
-        "WAITING_EMAIL": functools.partial(waiting_email, token=token),
-        "WAITING_LOCATION": functools.partial(
-            handle_waiting, api_key=yandex_api_key, token=token, db=db
-        ),
-        "WAITING_PIZZA": functools.partial(
-            handle_delivery, token=token, db=db
-        ),
-        "WAITING_PAYMENT": functools.partial(
-            handle_payment, provider_token=provider_token, db=db, token=token
-        ),
-    }
-    state_handler = states_functions[user_state]
-    try:
-        next_state = state_handler(bot, update)
-        db.set(chat_id, next_state)
-    except Exception as err:
-        logging.error(err)
+
+    db = get_database_connection(host, port, password)
+    with contextlib.ExitStack() as update_scope:
+        profile = update_scope.enter_context(profiler.profile_update(chat_id))
+        log_context = update_scope.enter_context(update_context(chat_id))
+        update_scope.enter_context(start_deadline(UPDATE_DEADLINE))
+        bot = profile.instrument(bot, "telegram")
+        db = profile.instrument(db, "redis")
+        saved_state = None if user_reply == "/start" else db.get(chat_id)
+        if saved_state is None:
+            user_state = "START"
+        else:
+            user_state = saved_state.decode("utf-8")
+        log_context["state"] = user_state
+        profile.set_handler(user_state, router.get_handler(user_state).__name__)
+
+        resources = Resources(
+            {
+                "db": lambda: db,
+                "token": lambda: get_token(client_id, client_secret, db),
+                "token_source": lambda: functools.partial(
+                    get_token, client_id, client_secret, db
+                ),
+                "api_key": lambda: yandex_api_key,
+                "provider_token": lambda: provider_token,
+            }
+        )
+        try:
+            next_state = router.dispatch(user_state, bot, update, resources)
+            if next_state is not None:
+                append_event(
+                    db,
+                    "transition",
+                    chat_id,
+                    from_state=user_state,
+                    to_state=next_state,
+                )
+                router.save_state(db, chat_id, next_state)
+        except CircuitOpenError as err:
+            logging.warning(err)
+            bot.send_message(
+                chat_id=chat_id,
+                text="Магазин временно недоступен, попробуйте через минуту",
+            )
+        except DeadlineExceeded as err:
+            logging.warning(err)
+            bot.send_message(
+                chat_id=chat_id,
+                text="Сервис отвечает слишком долго, попробуйте ещё раз",
+            )
+        except Exception as err:
+            logging.error(err)
 
 
 if __name__ == "__main__":
     load_dotenv()
+    setup_logging(
+        mode=os.getenv("LOG_MODE", "async"),
+        level=os.getenv("LOG_LEVEL", "DEBUG"),
+        log_format=os.getenv("LOG_FORMAT", "text"),
+        debug_per_second=int(os.getenv("LOG_DEBUG_PER_SECOND", 5)),
+    )
     token = os.getenv("TELEGRAM_TOKEN")
 
     provider_token = os.getenv("TRANZZO_PAYMENT_TOKEN")
@@ -551,6 +804,68 @@ if __name__ == "__main__":
 
     yandex_api_key = os.getenv("YANDEX_API_KEY")
 
+    workers = int(os.getenv("DISPATCHER_WORKERS", 4))
+    get_database_connection(
+        db_host,
+        db_port,
+        db_password,
+        max_connections=int(
+            os.getenv("REDIS_MAX_CONNECTIONS", workers * 2)
+        ),
+        connect_timeout=float(os.getenv("REDIS_CONNECT_TIMEOUT", 3)),
+        socket_timeout=float(os.getenv("REDIS_SOCKET_TIMEOUT", 5)),
+        health_check_interval=int(
+            os.getenv("REDIS_HEALTH_CHECK_INTERVAL", 30)
+        ),
+        parser=os.getenv("REDIS_PARSER"),
+    )
+
+    cassette_mode = os.getenv("HTTP_CASSETTE_MODE")
+    if cassette_mode == "record":
+        transport.record(os.environ["HTTP_CASSETTE_PATH"])
+    elif cassette_mode == "replay":
+        transport.replay(
+            os.environ["HTTP_CASSETTE_PATH"],
+            latency_scale=float(os.getenv("HTTP_REPLAY_LATENCY_SCALE", 1)),
+        )
+
+    UPDATE_DEADLINE = float(os.getenv("UPDATE_DEADLINE", UPDATE_DEADLINE))
+    courier_dispatch.BATCH_WINDOW = float(
+        os.getenv("COURIER_BATCH_WINDOW", courier_dispatch.BATCH_WINDOW)
+    )
+
+    slow_update_threshold = os.getenv("PROFILE_SLOW_UPDATES")
+    if slow_update_threshold:
+        profiler.enable(
+            threshold=float(slow_update_threshold),
+            buffer_size=int(os.getenv("PROFILE_BUFFER_SIZE", 100)),
+            cprofile_sample_rate=float(os.getenv("PROFILE_CPROFILE_RATE", 0)),
+        )
+        profile_dump_path = os.getenv("PROFILE_DUMP_PATH", "slow_updates.json")
+        signal.signal(
+            signal.SIGUSR1,
+            lambda signum, frame: profiler.dump_traces(profile_dump_path),
+        )
+
+    snapshot_path = os.getenv("CATALOG_SNAPSHOT_PATH", "catalog_snapshot.pickle")
+    snapshot.load_snapshot(snapshot_path)
+
+    def refresh_catalog_snapshot(bot, job):
+        db = get_database_connection(db_host, db_port, db_password)
+        try:
+            snapshot.refresh_snapshot(
+                snapshot_path, get_token(client_id, client_secret, db)
+            )
+        except Exception as err:
+            logger.warning("Не удалось обновить снимок каталога: %s", err)
+
+    def flush_courier_orders(bot, job):
+        db = get_database_connection(db_host, db_port, db_password)
+        try:
+            courier_dispatch.flush_orders(bot, db)
+        except Exception as err:
+            logger.error("Не удалось отправить заказы курьерам: %s", err)
+
     partial_handle_users_reply = functools.partial(
         handle_users_reply,
         host=db_host,
@@ -562,10 +877,29 @@ if __name__ == "__main__":
         yandex_api_key=yandex_api_key,
     )
 
-    updater = Updater(token)
+    updater = Updater(token, workers=workers)
     dispatcher = updater.dispatcher
+    updater.job_queue.run_repeating(log_stats, interval=300)
+    updater.job_queue.run_repeating(
+        flush_courier_orders,
+        interval=float(os.getenv("COURIER_FLUSH_INTERVAL", 5)),
+    )
+    updater.job_queue.run_repeating(
+        refresh_catalog_snapshot,
+        interval=int(os.getenv("CATALOG_SNAPSHOT_INTERVAL", 1800)),
+        first=0,
+    )
     dispatcher.add_handler(
-        MessageHandler(Filters.successful_payment, successful_payment_callback, pass_job_queue=True)
+        MessageHandler(
+            Filters.successful_payment,
+            functools.partial(
+                successful_payment_callback,
+                host=db_host,
+                port=db_port,
+                password=db_password,
+            ),
+            pass_job_queue=True,
+        )
     )
     dispatcher.add_handler(
         MessageHandler(Filters.location, partial_handle_users_reply)
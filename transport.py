@@ -0,0 +1,215 @@
+"""
+HTTP-транспорт для запросов к Elastic Path и Yandex.
+
+Все запросы идут через общую сессию ``session``. Таймаут каждого запроса
+берётся из дедлайна апдейта (см. deadline.py). По умолчанию сессия ходит
+в сеть, но в неё можно подключить запись или воспроизведение:
+
+- ``record(path)`` пишет пары запрос/ответ в кассету (gzip, JSON-строки),
+  заменяя токены, client_id/client_secret и api-ключи на ``***``;
+- ``replay(path, latency_scale)`` отдаёт ответы из кассеты, не обращаясь
+  в сеть, с исходной задержкой, умноженной на latency_scale.
+"""
+import atexit
+import gzip
+import json
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+import deadline
+
+SCRUBBED = "***"
+SECRET_FIELDS = {
+    "access_token",
+    "apikey",
+    "client_id",
+    "client_secret",
+    "password",
+}
+
+
+class DeadlineSession(requests.Session):
+    """
+    Сессия, которая берёт таймаут запроса из дедлайна апдейта.
+
+    После каждого запроса, в том числе неудачного, вызываются функции из
+    call_hooks с аргументами (method, url, duration, error).
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.call_hooks = []
+
+    def request(self, method, url, *args, **kwargs):
+        endpoint = deadline.get_endpoint(method, url)
+        started_at = time.perf_counter()
+        error = None
+        try:
+            return self.send_with_deadline(endpoint, method, url, args, kwargs)
+        except BaseException as err:
+            error = err
+            raise
+        finally:
+            duration = time.perf_counter() - started_at
+            for hook in self.call_hooks:
+                hook(method, url, duration, error)
+
+    def send_with_deadline(self, endpoint, method, url, args, kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = deadline.get_timeout(endpoint)
+        try:
+            return super().request(method, url, *args, **kwargs)
+        except requests.exceptions.Timeout as err:
+            remaining = deadline.get_remaining()
+            if remaining is not None and remaining <= 0:
+                deadline.record_exceeded(endpoint)
+                timeout = kwargs["timeout"]
+                read_timeout = (
+                    timeout[1] if isinstance(timeout, tuple) else timeout
+                )
+                raise deadline.DeadlineExceeded(
+                    endpoint, timeout=read_timeout
+                ) from err
+            raise
+
+
+session = DeadlineSession()
+
+
+def scrub_url(url):
+    split_url = urlsplit(url)
+    query = [
+        (name, SCRUBBED if name in SECRET_FIELDS else value)
+        for name, value in parse_qsl(split_url.query, keep_blank_values=True)
+    ]
+    return urlunsplit(split_url._replace(query=urlencode(query)))
+
+
+def scrub_json(data):
+    if isinstance(data, dict):
+        return {
+            key: SCRUBBED if key in SECRET_FIELDS else scrub_json(value)
+            for key, value in data.items()
+        }
+    if isinstance(data, list):
+        return [scrub_json(value) for value in data]
+    return data
+
+
+def scrub_body(body):
+    if not body:
+        return body
+    try:
+        return json.dumps(scrub_json(json.loads(body)), ensure_ascii=False)
+    except ValueError:
+        return body
+
+
+def get_request_key(method, url):
+    return f"{method} {scrub_url(url)}"
+
+
+def build_response(request, status_code, body, content_type):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = body.encode("utf-8")
+    response.headers = CaseInsensitiveDict({"Content-Type": content_type})
+    response.encoding = "utf-8"
+    response.url = request.url
+    response.request = request
+    return response
+
+
+class RecordingAdapter(HTTPAdapter):
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.cassette = gzip.open(path, "at", encoding="utf-8")
+        self.lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        started_at = time.perf_counter()
+        response = super().send(request, **kwargs)
+        response_body = response.content.decode("utf-8", errors="replace")
+        record = {
+            "key": get_request_key(request.method, request.url),
+            "status": response.status_code,
+            "content_type": response.headers.get("Content-Type", ""),
+            "body": scrub_body(response_body),
+            "elapsed": round(time.perf_counter() - started_at, 4),
+        }
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+        with self.lock:
+            self.cassette.write(line + "\n")
+            self.cassette.flush()
+        return response
+
+    def close(self):
+        super().close()
+        with self.lock:
+            self.cassette.close()
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    Отдаёт записанные ответы по методу и URL запроса. Если один и тот же
+    запрос записан несколько раз, ответы отдаются по порядку, а после
+    последнего повторяется последний.
+    """
+
+    def __init__(self, path, latency_scale=1.0):
+        super().__init__()
+        self.latency_scale = latency_scale
+        self.records = defaultdict(list)
+        self.positions = defaultdict(int)
+        self.lock = threading.Lock()
+        with gzip.open(path, "rt", encoding="utf-8") as cassette:
+            try:
+                for line in cassette:
+                    record = json.loads(line)
+                    self.records[record["key"]].append(record)
+            except EOFError:
+                # Кассета не была закрыта при записи: всё, что успели
+                # сбросить на диск, уже прочитано
+                pass
+
+    def send(self, request, **kwargs):
+        key = get_request_key(request.method, request.url)
+        with self.lock:
+            records = self.records.get(key)
+            if not records:
+                raise requests.exceptions.ConnectionError(
+                    f"Нет записанного ответа для {key}", request=request
+                )
+            position = self.positions[key]
+            record = records[min(position, len(records) - 1)]
+            self.positions[key] = position + 1
+
+        if self.latency_scale:
+            time.sleep(record["elapsed"] * self.latency_scale)
+        return build_response(
+            request, record["status"], record["body"], record["content_type"]
+        )
+
+    def close(self):
+        pass
+
+
+def mount(adapter):
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+
+def record(path):
+    adapter = RecordingAdapter(path)
+    atexit.register(adapter.close)
+    mount(adapter)
+
+
+def replay(path, latency_scale=1.0):
+    mount(ReplayAdapter(path, latency_scale))